@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""Microbenchmarks of the search functions in tf2search.py, run on a
+synthetic catalog built from the item names in blueprints.json. The catalog
+only depends on the seed and scale, so runs of different revisions can be
+compared."""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+from collections import namedtuple
+from statistics import median
+
+import tf2api
+import tf2search
+
+TF2Info = namedtuple('TF2Info', 'items itemsbyname itemsets attributes effects '
+                     'blueprints storeprices newstoreprices bundles '
+                     'backpackprices changed')
+
+Catalog = namedtuple('Catalog', 'tf2info items names itemsets bundles '
+                     'suggestions prices blueprints')
+
+WORDS = ('Frying Pan Bat Pistol Rocket Launcher Scattergun Medigun Hat Cap '
+         'Crown Helm Mask Boots Gloves Cloak Sword Axe Knife Watch Shotgun '
+         'Flamethrower Minigun Wrench Saxxy Ubersaw Sandvich Crate Key Tag '
+         'Paint Strange Festive Botkiller Australium Über Dapper Mann Co. '
+         'Supply Meet the Medic Team Spirit Taunt: Conga Kill').split()
+
+# Items that searches and price visualizations depend on
+FIXEDITEMS = (
+    (0, 'Bat', 'tf_weapon_bat', 'Bat', 'melee', ['Scout']),
+    (5021, 'Mann Co. Supply Crate Key', 'tool', 'Tool', None, []),
+    (5002, 'Refined Metal', 'craft_item', 'Craft Item', None, []),
+    (5001, 'Reclaimed Metal', 'craft_item', 'Craft Item', None, []),
+    (5000, 'Scrap Metal', 'craft_item', 'Craft Item', None, []),
+    (264, 'Frying Pan', 'saxxy', 'Frying Pan', 'melee',
+     ['Scout', 'Soldier', 'Pyro', 'Demoman', 'Heavy', 'Medic', 'Sniper']),
+    (18, 'Rocket Launcher', 'tf_weapon_rocketlauncher', 'Rocket Launcher',
+     'primary', ['Soldier']),
+    (22, 'Pistol', 'tf_weapon_pistol', 'Pistol', 'secondary',
+     ['Scout', 'Engineer']),
+    (2, 'Fire Axe', 'tf_weapon_fireaxe', 'Axe', 'melee', ['Pyro']),
+    (30, 'Invis Watch', 'tf_weapon_invis', 'Watch', 'pda2', ['Spy']),
+)
+
+# Items named in the replacements of blueprints
+BLUEPRINTNAMES = (
+    "The Gas Jockey's Gear", 'The Saharan Spy', 'The Tank Buster',
+    'The Croc-o-Style Kit', 'The Special Delivery',
+    "Santa's Little Accomplice Bundle", 'Modest Pile of Hat',
+    'Burned Banana Peel', 'Voodoo-Cursed Object',
+    "Dr. Grordbort's Victory Pack", "Dr. Grordbort's Moonman Pack",
+    "Dr. Grordbort's Brainiac Pack"
+)
+
+SLOTS = ('primary', 'secondary', 'melee', 'pda', 'pda2', 'building', 'misc',
+         'misc', 'misc', 'taunt', 'action')
+
+QUERIES = {
+    'word': ('pan', 'frying pan', 'meet the medic', 'rocket', 'über',
+             'strange festive', 'zzzz'),
+    'classtag': ('engi hats', 'primary weps', 'scout', 'hat', 'tournament',
+                 'soldier pyro melee'),
+    'price': ('unique > 1 ref hat', 'genuine < 4 ref hats', '< 3 ref',
+              'strange > 2 keys'),
+    'other': ('sets', 'the set 3 set', '264 18', 'new', 'bundles'),
+}
+
+PRICEVIZQUERIES = ('2.66 ref', '1.5 keys to ref', '3 keys', '5 scrap to rec')
+
+SUGGESTQUERIES = ('pan', 'Fr', 'über', 'sword', 'm')
+
+
+def makecatalog(scale=1, seed=440, blueprintsfile='blueprints.json'):
+    """Return a catalog of about 6000 items times scale"""
+    rng = random.Random(seed)
+
+    with open(blueprintsfile, encoding='utf-8') as f:
+        blueprintsdata = json.load(f)
+
+    names = set()
+    for required, results in blueprintsdata.values():
+        names.update(name for name in required + results
+                     if not name.startswith('Any '))
+    for class_ in tf2api.getallclasses():
+        names.add(f'{class_} Starter Pack')
+    names.update(BLUEPRINTNAMES)
+    names = sorted(names - {item[1] for item in FIXEDITEMS})
+
+    while len(names) < 6000 * scale:
+        words = rng.sample(WORDS, rng.randint(1, 4))
+        names.append(f"{' '.join(words)} {len(names)}")
+
+    classes = list(tf2api.getallclasses())
+
+    schemaitems = [makeschemaitem(rng, *item) for item in FIXEDITEMS]
+    for index, name in enumerate(names, 30000):
+        slot = rng.choice(SLOTS)
+        r = rng.random()
+        if r < 0.02:
+            itemclass, typename, slot = 'bundle', 'Bundle', None
+        elif r < 0.03:
+            itemclass, typename, slot = 'tool', 'Tournament Medal', 'misc'
+        elif r < 0.08:
+            itemclass, typename, slot = 'class_token', 'Token', None
+        elif slot == 'misc':
+            itemclass = 'tf_wearable'
+            typename = rng.choice(['Hat', 'Cosmetic', 'Mask', 'Misc'])
+        else:
+            itemclass, typename = f'tf_weapon_{slot}', slot.title()
+        used = rng.sample(classes, rng.choice([0, 1, 1, 1, 2, 9]))
+        schemaitems.append(makeschemaitem(rng, index, name, itemclass,
+                                          typename, slot, used))
+
+    setnames = [item['item_name'] for item in schemaitems[len(FIXEDITEMS):]
+                if item['item_type_name'] != 'Tournament Medal']
+    itemsets = [{'name': f'The Set {i}', 'items': rng.sample(setnames, 3)}
+                for i in range(60 * scale)]
+
+    attributes = [
+        {'name': 'damage bonus', 'hidden': False,
+         'description_string': '+%s1% damage bonus',
+         'description_format': 'value_is_percentage',
+         'effect_type': 'positive'},
+    ]
+
+    schema = {'result': {'items': schemaitems, 'item_sets': itemsets,
+                         'attributes': attributes,
+                         'attribute_controlled_attached_particles': []}}
+
+    items = tf2api.getitems(schema)
+    itemsbyname = tf2api.getitemsbyname(schema)
+
+    qualities = list(tf2api.getallqualities().values()) + ['Uncraftable']
+
+    storeprices = {}
+    bundles = {}
+    backpackprices = {}
+    for index, item in items.items():
+        isbundle = item['item_class'] == 'bundle'
+        if isbundle or rng.random() < 0.3:
+            tags = ['New'] if rng.random() < 0.05 else []
+            if isbundle:
+                tags.append('Bundles')
+                contents = ['Contains:'] + rng.sample(list(itemsbyname), 3)
+                bundles[index] = {
+                    'name': item['item_name'],
+                    'descriptions': {str(i): {'value': value}
+                                     for i, value in enumerate(contents)}
+                }
+            storeprices[index] = {'prices': {'USD': rng.randint(49, 2999)},
+                                  'tags': tags, 'classid': str(index)}
+
+        prices = {}
+        for quality in rng.sample(qualities, rng.randint(0, 4)):
+            low = round(rng.uniform(0.05, 80), 2)
+            denom = rng.choice(['Refined', 'Keys', 'Key', 'USD'])
+            prices[quality] = (f'{low:g} - {low + 0.11:g} {denom}'
+                               if rng.random() < 0.3 else f'{low:g} {denom}')
+        if prices:
+            backpackprices[index] = prices
+
+    backpackprices[5021] = {'Unique': '60.11 - 60.22 Refined'}
+    backpackprices[5002] = {'Unique': '1 Refined'}
+    backpackprices[5001] = {'Unique': '0.33 Refined'}
+    backpackprices[5000] = {'Unique': '0.11 Refined'}
+
+    tf2info = TF2Info(
+        items, itemsbyname, tf2api.getitemsets(schema),
+        tf2api.getattributes(schema), tf2api.getparticleeffects(schema),
+        tf2search._parseblueprints(blueprintsdata, itemsbyname), storeprices,
+        tf2api.getnewstoreprices(storeprices), bundles, backpackprices,
+        frozenset(getattr(tf2search, 'TF2SOURCES', ()))
+    )
+
+    itemsdict = tf2search.getitemsdict(tf2info)
+
+    names = {}
+    suggestions = [[], [], []]
+    for index, itemdict in itemsdict.items():
+        name = itemdict['name']
+        if (index == itemsbyname[name]['defindex'] and
+                tf2search.isvalidresult(itemdict)):
+            names[name] = index
+            suggestions[0].append(name)
+            suggestions[1].append(', '.join(itemdict['classes']))
+            suggestions[2].append(f'/{index}')
+
+    prices = {index: itemdict['marketprice']
+              for index, itemdict in itemsdict.items()}
+
+    return Catalog(tf2info, itemsdict, names, tf2info.itemsets,
+                   {str(k): v for k, v in bundles.items()}, suggestions,
+                   prices, blueprintsdata)
+
+
+def makeschemaitem(rng, index, name, itemclass, typename, slot, used):
+    item = {'defindex': index, 'item_name': name, 'item_class': itemclass,
+            'item_type_name': typename, 'min_ilevel': 1,
+            'max_ilevel': rng.choice([1, 10, 100]),
+            'image_url': f'https://steamcdn-a.akamaihd.net/{index}.png',
+            'image_url_large': f'https://steamcdn-a.akamaihd.net/{index}l.png'}
+    if slot:
+        item['item_slot'] = slot
+    if used:
+        item['used_by_classes'] = used
+    if rng.random() < 0.3:
+        item['item_description'] = f'A description of {name}.'
+    if rng.random() < 0.2:
+        item['attributes'] = [{'name': 'damage bonus', 'value': 1.25}]
+    return item
+
+
+def getbenchmarks(catalog):
+    """Return the benchmarks for a catalog as pairs of names and functions
+    that run them once. Those that need functions missing from this revision
+    of tf2search are left out."""
+    items = catalog.items
+    source = 'backpack.tf'
+
+    benchmarks = [
+        ('_parseblueprints', lambda: tf2search._parseblueprints(
+            catalog.blueprints, catalog.tf2info.itemsbyname)),
+        ('getitemsdict', lambda: tf2search.getitemsdict(catalog.tf2info)),
+        ('parseinput', lambda: [tf2search.parseinput(query)
+                                for queries in QUERIES.values()
+                                for query in queries]),
+    ]
+
+    indexes = {}
+
+    def addindex(name, function):
+        if all(hasattr(tf2search, attr) for attr in name.split('+')):
+            indexes[name] = function()
+            benchmarks.append((name, function))
+
+    addindex('WordIndex', lambda: tf2search.WordIndex(items))
+    addindex('ClassTagIndex', lambda: tf2search.ClassTagIndex(items))
+    addindex('getpricetable+PriceIndex', lambda: tf2search.PriceIndex(
+        tf2search.getpricetable(catalog.prices)[source]))
+    addindex('SuggestionIndex',
+             lambda: tf2search.SuggestionIndex(*catalog.suggestions))
+
+    kwargs = {}
+    for name, kwarg in (('WordIndex', 'wordindex'),
+                        ('ClassTagIndex', 'classtagindex'),
+                        ('getpricetable+PriceIndex', 'priceindex')):
+        if name in indexes:
+            kwargs[kwarg] = indexes[name]
+
+    for kind, queries in QUERIES.items():
+        benchmarks.append((f'search:{kind}', lambda queries=queries: [
+            tf2search.search(query, items, catalog.names, catalog.itemsets,
+                             catalog.bundles, source, **kwargs)
+            for query in queries]))
+
+    denomitems = {index: items[index] for index in
+                  tf2api.getalldenoms().values()}
+    denomitems[0] = items[0]
+
+    if hasattr(tf2search, 'getdenomtable'):
+        denomtable = tf2search.loaddenomtable(
+            tf2search.getdenomtable(denomitems, source))
+        benchmarks.append(('visualizeprice', lambda: [
+            tf2search.visualizeprice(query, denomitems, source, denomtable)
+            for query in PRICEVIZQUERIES]))
+    else:
+        benchmarks.append(('visualizeprice', lambda: [
+            tf2search.visualizeprice(query, denomitems, source)
+            for query in PRICEVIZQUERIES]))
+
+    if 'SuggestionIndex' in indexes:
+        benchmarks.append(('SuggestionIndex.get', lambda: [
+            indexes['SuggestionIndex'].get(query)
+            for query in SUGGESTQUERIES]))
+
+    if hasattr(tf2search, 'OwnershipIndex'):
+        rng = random.Random(0)
+        owned = {quality: sorted(rng.sample(list(items), 800))
+                 for quality in ('1', '3', '5', '6', '11')}
+        page = tf2search.OwnershipIndex.getbitset(list(items)[:1000])
+        benchmarks.append(('OwnershipIndex', lambda: tf2search.OwnershipIndex(
+            owned).getowned(page)))
+
+    return benchmarks
+
+
+def measure(function, repeat=5, mintime=0.2):
+    """Return the median seconds per call of a function, and the peak and
+    retained bytes allocated by a call"""
+    # Calls are grouped so each timing lasts long enough to be accurate
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= mintime / repeat or number >= 1 << 20:
+            break
+        number *= 2
+
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - t0) / number)
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = function()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return {'time': median(timings), 'peak': peak - before,
+            'retained': current - before}
+
+
+def run(scale, seed, repeat, select=None, verbose=True):
+    t0 = time.perf_counter()
+    catalog = makecatalog(scale, seed)
+    if verbose:
+        print(f'Built a catalog of {len(catalog.items):,} items in '
+              f'{time.perf_counter() - t0:.1f}s', file=sys.stderr)
+
+    results = {}
+    for name, function in getbenchmarks(catalog):
+        if select and not any(s in name for s in select):
+            continue
+        results[name] = measure(function, repeat)
+        if verbose:
+            print(f'{name:30} {formattime(results[name]["time"]):>10}',
+                  file=sys.stderr)
+
+    return {'scale': scale, 'seed': seed, 'results': results}
+
+
+def runrevision(revision, args):
+    """Run the benchmarks of this file against tf2search.py and tf2api.py
+    of a git revision and return the results"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tempdir:
+        for filename in ('tf2search.py', 'tf2api.py'):
+            source = subprocess.run(
+                ['git', 'show', f'{revision}:{filename}'], cwd=here,
+                check=True, capture_output=True).stdout
+            with open(os.path.join(tempdir, filename), 'wb') as f:
+                f.write(source)
+
+        # The modules are imported from the directory of the script
+        script = os.path.join(tempdir, os.path.basename(__file__))
+        shutil.copyfile(__file__, script)
+
+        command = [sys.executable, script, '-s', str(args.scale),
+                   '--seed', str(args.seed), '-r', str(args.repeat),
+                   '-o', '-']
+        if args.select:
+            command += ['-k', *args.select]
+
+        output = subprocess.run(command, cwd=here, check=True,
+                                stdout=subprocess.PIPE).stdout
+        return json.loads(output)
+
+
+def report(new, old=None):
+    """Print the results, compared with the old ones if given"""
+    header = f"{'benchmark':30} {'time':>10} {'peak':>10} {'retained':>10}"
+    if old:
+        header += f" {'old time':>10} {'speedup':>8} {'old peak':>10}"
+    print(header)
+
+    oldresults = old['results'] if old else {}
+    names = list(new['results']) + [name for name in oldresults
+                                     if name not in new['results']]
+
+    for name in names:
+        result = new['results'].get(name)
+        line = f'{name:30} '
+        line += (f"{formattime(result['time']):>10} "
+                 f"{formatsize(result['peak']):>10} "
+                 f"{formatsize(result['retained']):>10}" if result else
+                 f"{'-':>10} {'-':>10} {'-':>10}")
+        if old:
+            oldresult = oldresults.get(name)
+            if oldresult:
+                line += f" {formattime(oldresult['time']):>10}"
+                line += (f" {oldresult['time'] / result['time']:>7.2f}x"
+                         if result else f" {'-':>8}")
+                line += f" {formatsize(oldresult['peak']):>10}"
+            else:
+                line += f" {'-':>10} {'-':>8} {'-':>10}"
+        print(line)
+
+
+def formattime(seconds):
+    for unit, factor in (('s', 1), ('ms', 1e-3), ('µs', 1e-6)):
+        if seconds >= factor:
+            return f'{seconds / factor:.2f}{unit}'
+    return f'{seconds / 1e-9:.0f}ns'
+
+
+def formatsize(size):
+    for unit, factor in (('MiB', 1 << 20), ('KiB', 1 << 10)):
+        if abs(size) >= factor:
+            return f'{size / factor:.1f}{unit}'
+    return f'{size}B'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the search functions on a synthetic catalog')
+    parser.add_argument('-s', '--scale', type=int, default=1,
+                        help='multiple of the 6000 items of the catalog')
+    parser.add_argument('--seed', type=int, default=440,
+                        help='seed of the catalog')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of timings of which the median is taken')
+    parser.add_argument('-k', '--select', nargs='+',
+                        help='only run the benchmarks with these substrings')
+    parser.add_argument('-o', '--output',
+                        help='save the results as JSON to a file, or - for '
+                        'standard output')
+    parser.add_argument('-c', '--compare',
+                        help='compare with results saved in a file, or with '
+                        'those of a git revision')
+    args = parser.parse_args()
+
+    results = run(args.scale, args.seed, args.repeat, args.select)
+
+    if args.output == '-':
+        json.dump(results, sys.stdout)
+        return
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    old = None
+    if args.compare:
+        if os.path.isfile(args.compare):
+            with open(args.compare) as f:
+                old = json.load(f)
+        else:
+            old = runrevision(args.compare, args)
+        if (old['scale'], old['seed']) != (args.scale, args.seed):
+            print('The results compared are of a different catalog',
+                  file=sys.stderr)
+
+    report(results, old)
+
+
+if __name__ == '__main__':
+    main()
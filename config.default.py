@@ -4,6 +4,18 @@ apikey = ''
 backpackkey = ''
 # Blueprints file path
 blueprintsfile = 'blueprints.json'
+# API response cache directory (leave empty to disable)
+cachedir = '/tmp/itemtf/cache'
+# Seconds for which cached API responses are used without revalidating
+cachemaxage = 0
+# Compiled template cache directory (leave empty to disable)
+templatecachedir = '/tmp/itemtf/templates'
+# Bytes of rendered pages cached in memory by each web worker
+responsecachesize = 64 * 1024 * 1024
+# Seconds after which user profiles are refreshed in the background
+userrefreshage = 180
+# Seconds for which the steamids of vanity urls are cached
+vanityage = 24 * 60 * 60
 # Site homepage
 homepage = 'https://item.tf'
 # Homepage messages
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""Load test of the site. It boots main:app, optionally against a local
+Valkey loaded with the synthetic catalog of benchmark.py, sends a mix of
+requests at a target rate and reports the throughput and latency of each
+route."""
+import os
+import re
+import sys
+import math
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from collections import defaultdict
+from urllib.parse import quote_plus
+
+import aiohttp
+from slugify import slugify
+
+import tf2api
+
+# Weights of the kinds of requests in the default mix
+MIX = {
+    'home': 4,
+    'search': 16,
+    'classtag': 12,
+    'price': 4,
+    'all': 1,
+    'suggest': 5,
+    'item': 25,
+    'itemjson': 8,
+    'user': 2,
+}
+
+PRICEQUERIES = ('unique > 1 ref hat', 'genuine < 4 ref hats', '< 3 ref',
+                'strange > 2 keys', '2.66 ref', '1.5 keys to ref')
+
+# Routes of main.py by the pattern of their paths
+ROUTES = (
+    (r'/$', '/'),
+    (r'/search(\.json)?\?', r'/search\1'),
+    (r'/search/', '/search/{slug}'),
+    (r'/suggest\?', '/suggest'),
+    (r'/(id|profiles)/', r'/\1/{steamid}'),
+    (r'/\d+\.json$', '/{index}.json'),
+    (r'/\d+$', '/{index}'),
+    (r'/sitemap\.xml$', '/sitemap.xml'),
+    (r'/[^/?]+$', '/{slug}'),
+)
+
+
+def getroute(path):
+    """Return the route of main.py that a path is handled by"""
+    for pattern, route in ROUTES:
+        match = re.match(pattern, path)
+        if match:
+            return match.expand(route)
+    return path
+
+
+async def loadcatalog(scale, seed, users):
+    """Replace the catalog in the store with the synthetic one of
+    benchmark.py and add users with sessions, returning their session ids"""
+    import benchmark
+    import tf2search
+    import updatestore
+    from main import getuserkey, getsessionkey, session_age, setowneditems
+    from store import Redis
+
+    catalog = benchmark.makecatalog(scale, seed)
+
+    async def gettf2info(*args, **kwargs):
+        return catalog.tf2info
+
+    tf2search.gettf2info = gettf2info
+    await updatestore.main(True, grace=0)
+
+    rng = random.Random(seed)
+    indexes = list(catalog.names.values())
+    qualities = list(tf2api.getallqualities())
+
+    store = Redis.from_url('redis://localhost')
+    sids = []
+    async with store.pipeline(transaction=False) as pipe:
+        for i in range(users):
+            steamid = str(76561198000000000 + i)
+            sid = f'loadtest{i}'
+            user = {
+                'id': steamid,
+                'name': f'User {i}',
+                'url': f'/profiles/{steamid}',
+                'avatar': '',
+                'state': 'Offline',
+                'wishlist': [{'index': index, 'quality': 6}
+                             for index in rng.sample(indexes, 10)],
+                # Profiles are not refreshed from Steam during the test
+                'lastupdate': time.time() + 365 * 24 * 60 * 60
+            }
+            backpack = {'items': [
+                {'defindex': index, 'quality': quality}
+                for quality in rng.sample(qualities, 3)
+                for index in rng.sample(indexes, 100)
+            ]}
+            pipe.hset(getuserkey(steamid), mapping=user)
+            setowneditems(pipe, steamid, backpack)
+            pipe.sadd('users', steamid)
+            pipe.setex(getsessionkey(sid), int(session_age.total_seconds()),
+                       steamid)
+            sids.append(sid)
+        await pipe.execute()
+    await store.aclose()
+
+    return sids
+
+
+async def getsamples(session, url):
+    """Return the items of the site, to make the paths requested from"""
+    async with session.get(f'{url}/search.json?q=all&limit=5000') as response:
+        results = await response.json()
+    return [item for result in results for item in result['items']]
+
+
+def makerequests(items, count, seed, sids=(), users=0.1):
+    """Return a list of paths and session ids to request, mixed by MIX"""
+    rng = random.Random(seed)
+
+    names = [item['name'] for item in items]
+    words = sorted({word for name in names for word in name.lower().split()
+                    if word.isalpha() and len(word) > 2})
+    classes = [c.lower() for c in tf2api.getallclasses()]
+    tags = [t for t in tf2api.getalltags() if t not in ('new', 'bundle')]
+
+    kinds = list(MIX)
+    weights = list(MIX.values())
+
+    requests = []
+    while len(requests) < count:
+        kind = rng.choices(kinds, weights)[0]
+        item = rng.choice(items)
+
+        if kind == 'home':
+            paths = ['/']
+        elif kind == 'search':
+            query = ' '.join(rng.sample(words, rng.randint(1, 2)))
+            paths = [f'/search?q={quote_plus(query)}']
+        elif kind == 'classtag':
+            parts = rng.sample(classes, rng.randint(0, 1)) + [rng.choice(tags)]
+            paths = [f"/search/{'-'.join(parts)}"]
+        elif kind == 'price':
+            paths = [f'/search?q={quote_plus(rng.choice(PRICEQUERIES))}']
+        elif kind == 'all':
+            paths = ['/search?q=all&limit=100' if rng.random() < 0.8 else
+                     '/search.json?q=all']
+        elif kind == 'suggest':
+            # Each keystroke of a name being typed
+            name = item['name'][:rng.randint(2, 10)]
+            paths = [f'/suggest?q={quote_plus(name[:i])}'
+                     for i in range(1, len(name) + 1)]
+        elif kind == 'item':
+            paths = [f"/{slugify(item['name'])}"]
+        elif kind == 'itemjson':
+            paths = [f"/{item['index']}.json"]
+        elif kind == 'user':
+            if not sids:
+                continue
+            paths = [f'/profiles/{76561198000000000 + rng.randrange(len(sids))}']
+
+        sid = rng.choice(sids) if sids and rng.random() < users else None
+        requests.extend((path, sid) for path in paths)
+
+    return requests[:count]
+
+
+def readrequests(filename, count):
+    """Return the paths in a log file, one per line, repeated up to count"""
+    with open(filename) as f:
+        paths = [line.strip() for line in f if line.startswith('/')]
+    return [(paths[i % len(paths)], None) for i in range(count)]
+
+
+async def send(url, requests, rate, concurrency, timeout):
+    """Send the requests at rate per second and return the route, status
+    and latency of each"""
+    results = []
+
+    async def fetch(session, path, sid, scheduled):
+        # Latency is measured from when the request was due, so a server
+        # that falls behind is not hidden by requests waiting to be sent
+        cookies = {'sid': sid} if sid else None
+        try:
+            async with session.get(url + path, allow_redirects=False,
+                                   cookies=cookies) as response:
+                await response.read()
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status = type(e).__name__
+        results.append((getroute(path), status,
+                        time.perf_counter() - scheduled))
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        tasks = []
+        start = time.perf_counter()
+        for i, (path, sid) in enumerate(requests):
+            scheduled = start + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(
+                fetch(session, path, sid, scheduled)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    return results, elapsed
+
+
+def report(results, elapsed):
+    """Print the throughput and latency percentiles of each route"""
+    routes = defaultdict(list)
+    errors = defaultdict(int)
+    for route, status, latency in results:
+        routes[route].append(latency)
+        if type(status) is not int or status >= 500:
+            errors[route] += 1
+    routes['total'] = [latency for _, _, latency in results]
+    errors['total'] = sum(errors.values())
+
+    print(f"{'route':20} {'requests':>8} {'errors':>6} {'req/s':>8} "
+          f"{'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for route in sorted(routes, key=lambda route: (route == 'total', route)):
+        latencies = sorted(routes[route])
+        print(f'{route:20} {len(latencies):>8} {errors[route]:>6} '
+              f'{len(latencies) / elapsed:>8.1f} '
+              + ' '.join(f'{getpercentile(latencies, p) * 1000:>6.1f}ms'
+                         for p in (50, 95, 99, 100)))
+
+
+def getpercentile(values, percent):
+    """Return the percentile of sorted values by the nearest-rank method"""
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def startserver(port, workers, verbose):
+    """Start main:app in the way it is served"""
+    env = dict(os.environ, PYTHONOPTIMIZE='2')
+    output = None if verbose else subprocess.DEVNULL
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port),
+         '--workers', str(workers)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=output, stderr=output)
+    return server
+
+
+async def waitforserver(url, server, timeout=60):
+    """Wait until the server responds"""
+    async with aiohttp.ClientSession() as session:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if server and server.poll() is not None:
+                raise RuntimeError('The server exited')
+            try:
+                async with session.get(f'{url}/css/main.css') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError('The server did not start')
+
+
+async def main(args):
+    sids = []
+    if args.load is not None:
+        t0 = time.time()
+        sids = await loadcatalog(args.load, args.seed, args.users)
+        print(f'Loaded a catalog of scale {args.load} and {len(sids)} users '
+              f'in {time.time() - t0:.1f}s', file=sys.stderr)
+
+    server = None
+    url = args.url
+    if not url:
+        url = f'http://127.0.0.1:{args.port}'
+        server = startserver(args.port, args.workers, args.verbose)
+
+    try:
+        await waitforserver(url, server)
+
+        count = int(args.rate * args.duration)
+        if args.log:
+            requests = readrequests(args.log, count)
+        else:
+            async with aiohttp.ClientSession() as session:
+                items = await getsamples(session, url)
+            requests = makerequests(items, count, args.seed, sids,
+                                    args.logged_in)
+
+        print(f'Sending {count} requests at {args.rate:g}/s to {url}',
+              file=sys.stderr)
+        results, elapsed = await send(url, requests, args.rate,
+                                      args.concurrency, args.timeout)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    report(results, elapsed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load test the site with a mix of requests')
+    parser.add_argument('-l', '--load', type=int, metavar='SCALE',
+                        help='replace the catalog in the local store with '
+                        'the synthetic one of benchmark.py at this scale, '
+                        'and add users with sessions')
+    parser.add_argument('--users', type=int, default=50,
+                        help='number of users added with --load')
+    parser.add_argument('--logged-in', type=float, default=0.1,
+                        help='fraction of requests made by the users')
+    parser.add_argument('--seed', type=int, default=440,
+                        help='seed of the catalog and the requests')
+    parser.add_argument('-r', '--rate', type=float, default=50,
+                        help='requests sent per second')
+    parser.add_argument('-d', '--duration', type=float, default=30,
+                        help='seconds for which requests are sent')
+    parser.add_argument('-c', '--concurrency', type=int, default=100,
+                        help='maximum number of open connections')
+    parser.add_argument('-t', '--timeout', type=float, default=30,
+                        help='seconds after which a request fails')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of server workers')
+    parser.add_argument('-p', '--port', type=int, default=8765,
+                        help='port of the server')
+    parser.add_argument('-u', '--url',
+                        help='test a server that is already running instead')
+    parser.add_argument('--log',
+                        help='replay the paths in a file, one per line, '
+                        'instead of the mix')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show the output of the server')
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
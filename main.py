@@ -2,15 +2,17 @@ import os
 import time
 import random
 import asyncio
+import hashlib
 from base64 import b64encode
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
+from contextvars import ContextVar
 from datetime import datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
 from urllib.parse import urlparse
-from urllib.error import URLError
 
 import jinja2
 import orjson
-from blacksheep.contents import Content
+from blacksheep.contents import Content, StreamedContent
 from blacksheep.cookies import Cookie
 from blacksheep.exceptions import NotFound
 from blacksheep.messages import Request, Response
@@ -19,6 +21,7 @@ from blacksheep.server.files import get_default_extensions
 from blacksheep.server.responses import text, html, redirect, moved_permanently
 from openid.consumer import consumer
 from redis.asyncio.connection import BlockingConnectionPool
+from redis.exceptions import RedisError
 from slugify import slugify
 
 import config
@@ -48,9 +51,17 @@ if os.environ.get('PYTHONTRACEMALLOC'):
 
     memtask = asyncio.create_task(take_snapshots())
 
-jinja_env = jinja2.Environment(loader=jinja2.PackageLoader(__name__),
-                               autoescape=True, trim_blocks=True,
-                               enable_async=True, auto_reload=__debug__)
+# Compiled templates are shared by the workers and kept across restarts
+templatecachedir = getattr(config, 'templatecachedir', None)
+if templatecachedir:
+    os.makedirs(templatecachedir, exist_ok=True)
+
+jinja_env = jinja2.Environment(
+    loader=jinja2.PackageLoader(__name__), autoescape=True, trim_blocks=True,
+    enable_async=True, auto_reload=__debug__,
+    bytecode_cache=(jinja2.FileSystemBytecodeCache(templatecachedir)
+                    if templatecachedir else None)
+)
 
 jinja_env.filters['slugify'] = slugify
 
@@ -65,6 +76,91 @@ store = Redis(
 
 app = Application(show_error_details=__debug__)
 
+# Format in which items are stored: 1 for hashes of JSON fields, 2 for a
+# single JSON value per item
+catalogformat = 2
+
+# Generation and item format of the catalog that is being served, read from
+# the store by the requests that use it
+generation = ContextVar('generation', default=0)
+itemformat = ContextVar('itemformat', default=1)
+
+# Fields of the items kept in memory for searching them
+searchfields = ('index', 'name', 'image', 'classes', 'tags', 'marketprice')
+
+SearchSnapshot = namedtuple('SearchSnapshot', 'items names itemsets bundles '
+                            'wordindex classtagindex priceindexes '
+                            'denomtables')
+
+# Search data and indexes of the items, reloaded whenever they are updated
+searchsnapshot = (None, None)
+suggestionindex = (None, None)
+
+# Seconds after which the profile of a user is refreshed
+userrefreshage = getattr(config, 'userrefreshage', 180)
+
+# Seconds for which one worker or updateusers.py refreshes a user alone
+userrefreshlease = 30
+
+# Seconds for which the steamids of vanity urls are cached, or their absence
+vanityage = getattr(config, 'vanityage', 24 * 60 * 60)
+unknownvanityage = 10 * 60
+
+# Computations in progress by key, shared by the requests that need them
+inflight = {}
+
+# Search pages with more items than this are sent as they are rendered
+streamcount = 1000
+
+# The items of a cached page are a bitset of the indexes of the items on it
+CachedResponse = namedtuple('CachedResponse', 'etag lastmodified contenttype '
+                            'body items')
+
+# Rendered pages by catalog version and request, least recently used first
+responsecache = OrderedDict()
+responsecachesize = 0
+responsecachelimit = getattr(config, 'responsecachesize', 64 * 1024 * 1024)
+
+# Streamed pages are only cached up to this size, which bounds the memory each
+# stream holds on to
+streamcachelimit = responsecachelimit // 16
+
+
+async def opensession(application: Application):
+    await tf2api.opensession(limit=50, timeout=10)
+
+
+async def closesession(application: Application):
+    await tf2api.closesession()
+
+
+async def warmup(application: Application):
+    """Compile the templates and load the search snapshot so that the first
+    requests of the worker are served as fast as the rest"""
+    t0 = time.time()
+
+    templates = jinja_env.list_templates()
+    for template in templates:
+        jinja_env.get_template(template)
+
+    t1 = time.time()
+
+    try:
+        await getsearchsnapshot(await usecatalog())
+    except RedisError as e:
+        logger.warning(f'Could not load the search snapshot: {e}')
+
+    t2 = time.time()
+
+    logger.info(f'Compiled {len(templates)} templates in {t1 - t0:.3f}s and '
+                f'loaded the search snapshot in {t2 - t1:.3f}s')
+
+
+app.on_start += opensession
+app.on_start += warmup
+app.on_stop += closesession
+
+
 def json(data, status: int = 200) -> Response:
     return Response(
         status, None, Content(b'application/json', orjson.dumps(data))
@@ -73,9 +169,10 @@ def json(data, status: int = 200) -> Response:
 
 @app.router.get('/')
 async def home(request: Request):
-    t0, newitemsindexes, user = await asyncio.gather(
-        store.get('items:lastupdated'),
-        store.srandmember('items:new', 4),
+    _, t0 = await usecatalog()
+
+    newitemsindexes, user = await asyncio.gather(
+        store.srandmember(getcatalogkey('items:new'), 4),
         getcurrentuser(request)
     )
 
@@ -105,10 +202,11 @@ async def home(request: Request):
 @app.router.get('/search.json')
 @app.router.get('/search')
 async def search(request: Request, slug: str = None):
-    user_task = asyncio.create_task(getcurrentuser(request))
-
     is_json = request.url.path.endswith(b'.json')
 
+    user_task = (asyncio.create_task(getcurrentuser(request))
+                 if not is_json else None)
+
     query = (
         slug.replace('-', ' ') if slug else request.query.get('q', [''])[-1]
     )
@@ -118,14 +216,51 @@ async def search(request: Request, slug: str = None):
             return {'error': 'No query provided.'}
         return redirect('/')
 
-    elif query == 'random':
-        index = await store.srandmember('items:indexes')
+    version = await usecatalog()
+
+    if query == 'random':
+        index = await store.srandmember(getcatalogkey('items:indexes'))
         return redirect('/{}{}'.format(index, '.json' if is_json else ''))
 
-    itemnames = await store.hgetall('items:names')
+    snapshot = await getsearchsnapshot(version)
+
+    if query in snapshot.names:
+        return redirect('/{}'.format(snapshot.names[query]))
+
+    sources = ('backpack.tf',)
+    pricesource = request.cookies.get('price_source')
+    if pricesource not in sources:
+        pricesource = sources[0]
+
+    user = await user_task if user_task else None
+
+    offset, limit = getpage(request)
+
+    key = (is_json, query, pricesource, offset, limit)
 
-    if query in itemnames:
-        return redirect('/{}'.format(itemnames[query]))
+    page = getcachedentry(version, key)
+    if page is None and not (is_json and query == 'all'):
+        # Requests for a page that is not cached share one render of it
+        page = await coalesce(('page', version, key), buildsearch, version,
+                              key, snapshot)
+    if page is None:
+        # Pages sent as they are rendered are built by each request
+        page = await buildsearch(version, key, snapshot, stream=True)
+
+    if type(page) is CachedResponse:
+        return getresponse(request, page,
+                           await getownedfragment(user, page.items))
+
+    contenttype, chunks, items = page
+    return streamresponse(request, version, key, contenttype, chunks,
+                          await getownedfragment(user, items), items)
+
+
+async def buildsearch(version, key, snapshot, stream=False):
+    """Run the search of a request and cache its page, which is returned.
+    A page too large to render at once is instead returned as its content
+    type, chunks and item bitset to stream, or None unless stream is true."""
+    is_json, query, pricesource, offset, limit = key
 
     t0 = time.time()
 
@@ -135,25 +270,23 @@ async def search(request: Request, slug: str = None):
     priceviz = False
 
     if query == 'all':
-        items = store.Hashes(
-            [getitemkey(k.decode()) for k in await store.sort('items')])
-        results = [tf2search.getsearchresult(items=items)]
+        results = [tf2search.getsearchresult(items=list(snapshot.items))]
     else:
-        sources = ('backpack.tf',)
-        pricesource = request.cookies.get('price_source')
-        if pricesource not in sources:
-            pricesource = sources[0]
-
-        items = {
-            item['index']: item async for item in store.Hashes([
-                getitemkey(5021),  # Key
-                getitemkey(5002),  # Refined
-                getitemkey(5001),  # Reclaimed
-                getitemkey(5000),  # Scrap
-                getitemkey(0)  # Weapon
-            ])
-        }
-        results = tf2search.visualizeprice(query, items, pricesource)
+        results = None
+
+        if tf2search.ispricevisualization(query):
+            items = {
+                item['index']: item async for item in iteritems([
+                    getitemkey(5021),  # Key
+                    getitemkey(5002),  # Refined
+                    getitemkey(5001),  # Reclaimed
+                    getitemkey(5000),  # Scrap
+                    getitemkey(0)  # Weapon
+                ])
+            }
+            results = tf2search.visualizeprice(
+                query, items, pricesource,
+                snapshot.denomtables.get(pricesource))
 
         input_ = tf2search.parseinput(query)
         classes = input_['classes']
@@ -169,27 +302,30 @@ async def search(request: Request, slug: str = None):
                     results[0]['items'] = items
 
         elif classes or tags:
-            results = await getresults(classes, tags)
+            results = getresults(classes, tags, snapshot.classtagindex)
 
         else:
-            itemsdict = await store.SearchHashSet(
-                'items', getitemkey,
-                ('index', 'name', 'image', 'classes', 'tags', 'marketprice'),
-                int)
+            results = tf2search.search(query, snapshot.items, snapshot.names,
+                                       snapshot.itemsets, snapshot.bundles,
+                                       pricesource, snapshot.wordindex,
+                                       snapshot.classtagindex,
+                                       snapshot.priceindexes.get(pricesource))
 
-            itemsets = await store.get('items:sets')
-            bundles = await store.get('items:bundles')
+            for result in results:
+                result['items'] = [item['index'] for item in result['items']]
 
-            results = tf2search.search(query, itemsdict, itemnames,
-                                       itemsets, bundles, pricesource)
+    # Items of the page, of which those owned by the user are marked
+    # separately so that the page can be cached for everyone
+    items = 0
 
-            for result in results:
-                result['items'] = store.Hashes(
-                    [h.key for h in result['items']])
+    if not priceviz:
+        items = tf2search.OwnershipIndex.getbitset(
+            paginate(results, offset, limit))
 
     t1 = time.time()
 
-    count = sum(len(result['items']) for result in results)
+    count = sum(result.get('count', len(result['items']))
+                for result in results)
 
     all_classes = list(tf2api.getallclasses().keys())
     classes_text = getlistastext(sorted(classes, key=all_classes.index))
@@ -219,49 +355,70 @@ async def search(request: Request, slug: str = None):
     else:
         description = f'Search results for "{query}" items in TF2.'
 
-    qualities = defaultdict(set)
-
-    user = await user_task
-    if user:
-        for quality, indexes in user.get('items', {}).items():
-            for index in indexes:
-                qualities[index].add(quality)
-
     if is_json:
-        for result in results:
-            result['items'] = [item async for item in result['items']]
-        return json(results)
+        if query == 'all':
+            return b'application/json', iterjson(results), items
+        # Price visualization items are already a list of item counts
+        if not priceviz:
+            for result in results:
+                result['items'] = [item async for item in result['items']]
+        return cachebody(version, key, b'application/json',
+                         orjson.dumps(results))
     else:
-        return await render('search.html',
-                            query=query,
-                            description=description,
-                            results=results,
-                            qualities=qualities,
-                            count=count,
-                            time=round(t1 - t0, 3))
+        params = dict(query=query, description=description, results=results,
+                      count=count, offset=offset, limit=limit,
+                      time=round(t1 - t0, 3))
+        if sum(len(result['items']) for result in results) > streamcount:
+            if not stream:
+                return None
+            return (b'text/html; charset=utf-8',
+                    renderchunks('search.html', **params), items)
+        body = await renderstring('search.html', **params)
+        return cachebody(version, key, b'text/html; charset=utf-8',
+                         body.encode(), items)
 
 
 @app.router.get('/{str:slug}')
 @app.router.get('/{int:index}.json')
 @app.router.get('/{int:index}')
 async def item(request: Request, slug: str = None, index: int = None):
-    user_task = asyncio.create_task(getcurrentuser(request))
-
     is_json = request.url.path.endswith(b'.json')
 
-    item = await (getitembyslug(slug) if slug else getitem(index))
+    version = await usecatalog()
 
-    if item and index is not None and not is_json:
-        slug = slugify(item['name'])
-        return moved_permanently(f'/{slug}')
+    if index is not None and not is_json:
+        item = await getitem(index)
+        if not item:
+            raise NotFound()
+        return moved_permanently(f"/{slugify(item['name'])}")
 
-    if not item:
+    key = (request.url.path,)
+
+    entry = getcachedentry(version, key)
+    if entry is None:
+        # Requests for a page that is not cached share one render of it
+        entry = await coalesce(('page', version, key), builditem, version,
+                               key, is_json, slug, index)
+
+    if entry is None:
         if is_json:
             return json({'error': 'Item does not exist.'})
         raise NotFound()
 
+    return getresponse(request, entry)
+
+
+async def builditem(version, key, is_json, slug=None, index=None):
+    """Render the page of an item and cache it, returning None if there is no
+    such item"""
+    item = await (getitembyslug(slug) if slug else getitem(index))
+
+    if not item:
+        return None
+
     if is_json:
-        return json(item)
+        return cachebody(version, key, b'application/json',
+                         orjson.dumps(item))
     else:
         name = item['name']
         tags_text = '/'.join(item['tags']) if item['tags'] else 'item'
@@ -283,13 +440,37 @@ async def item(request: Request, slug: str = None, index: int = None):
             if description[-1] not in ('.', '?', '!'):
                 description += '.'
 
-        user = await user_task
-
-        return await render('item.html',
-                            item=item,
-                            user=user,
-                            homepage=config.homepage,
-                            description=description)
+        body = await renderstring('item.html',
+                                  item=item,
+                                  homepage=config.homepage,
+                                  description=description)
+        return cachebody(version, key, b'text/html; charset=utf-8',
+                         body.encode())
+
+
+async def iterjson(results):
+    """Serialize search results to JSON in chunks as their items are fetched"""
+    yield b'['
+    for i, result in enumerate(results):
+        # The items are written as the last field of a result
+        head = orjson.dumps({field: value for field, value in result.items()
+                             if field != 'items'})
+        yield (b',' if i else b'') + head[:-1] + b',"items":['
+
+        items = result['items']
+        chunk = []
+        count = 0
+        async for item in items:
+            chunk.append(orjson.dumps(item))
+            if len(chunk) == items.bufsize:
+                yield (b',' if count else b'') + b','.join(chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            yield (b',' if count else b'') + b','.join(chunk)
+
+        yield b']}'
+    yield b']'
 
 
 def getlistastext(l, default=''):
@@ -314,10 +495,12 @@ async def wishlist(request: Request, option):
     form = await request.form() or {}
 
     if option == 'add':
+        await usecatalog()
+
         index = int(form.get('index'))
         quality = int(form.get('quality'))
 
-        if (await store.sismember('items:indexes', index) and
+        if (await store.sismember(getcatalogkey('items:indexes'), index) and
                 quality in tf2api.getallqualities()):
 
             if len(user['wishlist']) < 500:
@@ -341,19 +524,16 @@ async def wishlist(request: Request, option):
 async def suggest(request: Request):
     query = request.query.get('q', [''])[-1]
 
-    allsuggestions = await store.get('items:suggestions')
+    try:
+        limit = min(int(request.query.get('limit', [10])[-1]), 100)
+    except ValueError:
+        limit = 10
+
     suggestions = (query, [], [], [])
 
     if query:
-        for name, desc, path in zip(*allsuggestions):
-            foldedname = tf2search.foldaccents(name)
-
-            if query in foldedname or query in foldedname.lower():
-                suggestions[1].append(name)
-                suggestions[2].append(desc)
-                suggestions[3].append(path)
-    else:
-        suggestions = (query, *allsuggestions)
+        index = await getsuggestionindex(await usecatalog())
+        suggestions = (query, *index.get(query, limit))
 
     return json(suggestions)
 
@@ -374,6 +554,7 @@ async def user(request: Request, steamid):
         if user['url'] != path:
             return redirect(user['url'])
 
+        await usecatalog()
         items = await getitems(item['index'] for item in user['wishlist'])
 
         for i, item in enumerate(items):
@@ -383,9 +564,12 @@ async def user(request: Request, steamid):
     else:
         raise NotFound()
 
+    lastupdated = int(time.time() - user['lastupdate']) // 60
+
     return await render('user.html',
                         user=user,
-                        items=items)
+                        items=items,
+                        lastupdated=lastupdated)
 
 
 @app.router.get('/login')
@@ -429,9 +613,10 @@ async def login_verify(request: Request):
 
 @app.router.get('/sitemap.xml')
 async def sitemap(request: Request):
+    await usecatalog()
     return Response(200, content=Content(
         b'application/xml;charset=UTF-8',
-        (await store.get('sitemap')).encode()))
+        (await store.get(getcatalogkey('sitemap'))).encode()))
 
 
 @app.exception_handler(404)
@@ -447,93 +632,337 @@ async def error500(self, request: Request, exception):
 
 async def render(template, *args, **params):
     """Render HTML template"""
+    return html(await renderstring(template, **params), *args)
+
+
+async def renderstring(template, **params):
+    """Render template as a string"""
     template = jinja_env.get_template(template)
-    return html(await template.render_async(params), *args)
+    return await template.render_async(params)
 
 
-async def getresults(classes, tags):
-    key = getsearchkey(classes, tags)
-    multikey = getsearchkey(classes, tags, 'Multi')
-    allkey = getsearchkey(classes, tags, 'All')
+async def renderchunks(template, size=16384, **params):
+    """Render template in chunks of at least size characters as it is
+    generated, each ending at the end of a template output"""
+    template = jinja_env.get_template(template)
+    chunk = []
+    length = 0
+    async for output in template.generate_async(params):
+        chunk.append(output)
+        length += len(output)
+        if length >= size:
+            yield ''.join(chunk).encode()
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk).encode()
+
+
+async def getownedfragment(user, items):
+    """Render the script that marks the items of a page owned by the user"""
+    if not (user and items):
+        return b''
+
+    qualities = await store.hgetallbytes(getownedkey(user['id']))
+    if qualities:
+        index = tf2search.OwnershipIndex.frombytes(qualities)
+    elif user.get('items'):
+        # Profiles stored before the bitsets, until they are refreshed
+        index = tf2search.OwnershipIndex(user['items'])
+    else:
+        return b''
 
-    title = tf2search.getclasstagtitle(classes, tags)
+    owned = index.getowned(items)
+    if not owned:
+        return b''
 
-    keys = (key, multikey, allkey)
-    titles = (title, 'Multi-Class Items', 'All-Class Items')
+    return (await renderstring('owned.html', qualities=owned)).encode()
 
-    is_cached = any(
-        await asyncio.gather(store.exists(key), store.exists(allkey))
-    )
 
-    if not is_cached:
-        classeskey = 'temp:classes'
-        tagskey = 'temp:tags'
-        remove = []
+def getcachedentry(version, key):
+    """Return the cached response entry for the catalog version"""
+    entry = responsecache.get((version, key))
+    if entry is not None:
+        responsecache.move_to_end((version, key))
+    return entry
+
 
-        async with store.pipeline() as pipe:
-            classkeys = [getclasskey(c) for c in classes] or ['items']
-            pipe.sunionstore(classeskey, *classkeys)
+def streamresponse(request: Request, version, key, contenttype, chunks,
+                   fragment=b'', items=0):
+    """Return a response streaming the chunks of its body, which is cached for
+    the catalog version once they have all been sent unless it is too large
 
-            # Get only the specified weapon types
-            if (
-                'weapon' in tags and
-                not tags.isdisjoint(tf2api.getweapontags())
-            ):
-                tags.remove('weapon')
-                remove.append(gettagkey('token'))
+    The fragment of the user is inserted at the end of the body of the page,
+    so the last chunk is held back until the next one arrives.
+    """
+    headers, modified = getheaders(request, getetag(version, key),
+                                   getlastmodified(version), fragment)
+    if not modified:
+        return Response(304, headers)
 
-            tagkeys = [gettagkey(tag) for tag in tags] or ['items']
-            pipe.sunionstore(tagskey, *tagkeys)
+    async def stream():
+        body = bytearray()
+        last = None
+        async for chunk in chunks:
+            if body is not None:
+                body += chunk
+                if len(body) > streamcachelimit:
+                    body = None
+            if last is not None:
+                yield last
+            last = chunk
+        if last is not None:
+            if fragment:
+                i = last.rfind(b'</body>')
+                last = last[:i] + fragment + last[i:]
+            yield last
+        if body is not None:
+            cachebody(version, key, contenttype, bytes(body), items)
 
-            # Hide medals if not explicitly searching for them
-            if 'tournament' not in tags:
-                remove.append(gettagkey('tournament'))
+    return Response(200, headers, StreamedContent(contenttype, stream))
 
-            if remove:
-                pipe.sdiffstore(tagskey, *([tagskey] + remove))
 
-            pipe.sinterstore(key, classeskey, tagskey)
-            pipe.sinterstore(multikey, key, getclasskey(multi=True))
-            pipe.sinterstore(allkey, tagskey, getclasskey())
-            pipe.sdiffstore(key, key, multikey, allkey)
+def cachebody(version, key, contenttype, body, items=0):
+    """Cache the body of a response for the catalog version"""
+    global responsecachesize
 
-            pipe.delete(classeskey)
-            pipe.delete(tagskey)
+    entry = CachedResponse(getetag(version, key), getlastmodified(version),
+                           contenttype, body, items)
 
-            for k in keys:
-                pipe.sort(k, store=k)
-                pipe.expire(k, 3600)
+    previous = responsecache.pop((version, key), None)
+    if previous is not None:
+        responsecachesize -= len(previous.body)
 
-            await pipe.execute()
+    responsecache[(version, key)] = entry
+    responsecachesize += len(body)
 
-    async def getkeys(key):
-        return [getitemkey(k) for k in await store.lrange(key, 0, -1)]
+    # Pages of previous versions are no longer requested and are evicted first
+    while responsecachesize > responsecachelimit and responsecache:
+        _, evicted = responsecache.popitem(last=False)
+        responsecachesize -= len(evicted.body)
 
-    results = []
+    return entry
+
+
+def getetag(version, key):
+    """Return the ETag of the page for a request and catalog version, which
+    every worker gives the same page"""
+    return '"{}"'.format(hashlib.blake2b(
+        repr((version, key)).encode(), digest_size=16).hexdigest()).encode()
 
-    allitemkeys = await asyncio.gather(*[getkeys(k) for k in keys])
 
-    for title, itemkeys in zip(titles, allitemkeys):
-        if itemkeys:
-            results.append(tf2search.getsearchresult(
-                title=title, items=store.Hashes(itemkeys)))
+def getlastmodified(version):
+    return formatdate(version[1], usegmt=True).encode()
+
+
+def getresponse(request: Request, entry, fragment=b''):
+    """Return a response for a cached entry with the fragment of the user
+
+    The fragment is inserted at the end of the body of the page, and the
+    response is not modified if the client already has the same version.
+    """
+    headers, modified = getheaders(request, entry.etag, entry.lastmodified,
+                                   fragment)
+    if not modified:
+        return Response(304, headers)
+
+    body = entry.body
+    if fragment:
+        i = body.rfind(b'</body>')
+        body = body[:i] + fragment + body[i:]
+
+    return Response(200, headers, Content(entry.contenttype, body))
+
+
+def getheaders(request: Request, etag, lastmodified, fragment=b''):
+    """Return the headers of a page with the fragment of the user and whether
+    the client has a different version of it"""
+    if fragment:
+        etag = b'%s-%s"' % (etag[:-1], hashlib.blake2b(
+            fragment, digest_size=8).hexdigest().encode())
+
+    headers = [(b'ETag', etag), (b'Vary', b'Cookie'),
+               (b'Cache-Control', b'private, no-cache' if fragment else
+                b'no-cache')]
+    if not fragment:
+        headers.append((b'Last-Modified', lastmodified))
+
+    return headers, ismodified(request, etag,
+                               None if fragment else lastmodified)
+
+
+def ismodified(request: Request, etag, lastmodified=None):
+    """Return whether the version of the client differs from the given one"""
+    etags = request.get_first_header(b'If-None-Match')
+    if etags is not None:
+        return not any(tag.strip().removeprefix(b'W/') in (etag, b'*')
+                       for tag in etags.split(b','))
+
+    since = request.get_first_header(b'If-Modified-Since')
+    if since is not None and lastmodified is not None:
+        try:
+            return (parsedate_to_datetime(since.decode()) <
+                    parsedate_to_datetime(lastmodified.decode()))
+        except (TypeError, ValueError):
+            pass
+
+    return True
+
+
+def getresults(classes, tags, classtagindex):
+    title = tf2search.getclasstagtitle(classes, tags)
+    titles = (title, 'Multi-Class Items', 'All-Class Items')
+
+    results = []
+
+    for title, indexes in zip(titles, classtagindex.getresults(classes, tags)):
+        if indexes:
+            results.append(tf2search.getsearchresult(title=title,
+                                                     items=indexes))
 
     return results
 
 
-def getsearchkey(classes=None, tags=None, type_=''):
-    concat = lambda l: ','.join(sorted(l)) if l else '*'
-    return 'items:search:classes={}&tags={}:{}'.format(concat(classes),
-                                                       concat(tags), type_)
+def getpage(request: Request):
+    """Return the offset and limit of the search results requested"""
+    try:
+        offset = max(0, int(request.query.get('offset', [0])[-1]))
+    except ValueError:
+        offset = 0
+
+    try:
+        limit = int(request.query['limit'][-1])
+    except (KeyError, ValueError):
+        limit = None
+
+    # A limit below 1 is the same as none
+    if limit is not None and limit < 1:
+        limit = None
+
+    return offset, limit
+
+
+def paginate(results, offset=0, limit=None):
+    """Replace the item indexes of search results with an iterator over the
+    items from offset up to limit, counting all the items of each result,
+    and return the indexes of the items in the page"""
+    pageindexes = []
+
+    for result in results:
+        indexes = result.pop('items')
+        page = indexes[offset:None if limit is None else offset + limit]
+
+        result['count'] = len(indexes)
+        result['items'] = iteritems([getitemkey(index) for index in page])
+        pageindexes.extend(page)
+
+        offset = max(0, offset - len(indexes))
+        if limit is not None:
+            limit -= len(page)
+
+    return pageindexes
+
+
+async def getsearchsnapshot(version):
+    global searchsnapshot
+
+    if searchsnapshot[0] != version:
+        snapshot = await coalesce(('searchsnapshot', version),
+                                  loadsearchsnapshot)
+        searchsnapshot = (version, snapshot)
+
+    return searchsnapshot[1]
+
+
+async def loadsearchsnapshot():
+    """Load the search data of the items and build their indexes"""
+    (names, itemsets, bundles, prices, denoms,
+     indexes) = await asyncio.gather(
+        store.hgetall(getcatalogkey('items:names')),
+        store.get(getcatalogkey('items:sets')),
+        store.get(getcatalogkey('items:bundles')),
+        store.get(getcatalogkey('items:prices')),
+        store.get(getcatalogkey('items:denoms')),
+        store.sort(getcatalogkey('items'))
+    )
+
+    items = {}
+    async for item in iteritems([getitemkey(index.decode())
+                                 for index in indexes]):
+        items[item['index']] = {field: item[field] for field in searchfields}
+
+    return SearchSnapshot(
+        items, names, itemsets, bundles, tf2search.WordIndex(items),
+        tf2search.ClassTagIndex(items),
+        {source: tf2search.PriceIndex(table, items)
+         for source, table in (prices or {}).items()},
+        {source: tf2search.loaddenomtable(table)
+         for source, table in (denoms or {}).items()})
+
+
+async def getsuggestionindex(version):
+    global suggestionindex
+
+    if suggestionindex[0] != version:
+        index = await coalesce(('suggestionindex', version),
+                               loadsuggestionindex)
+        suggestionindex = (version, index)
+
+    return suggestionindex[1]
+
+
+async def loadsuggestionindex():
+    suggestions = await store.get(getcatalogkey('items:suggestions'))
+    return tf2search.SuggestionIndex(*suggestions)
 
 
-def getclasskey(class_=None, multi=False):
-    class_ = 'Multi' if multi else (class_ or 'All')
-    return 'items:class:{}'.format(class_)
+def runonce(key, function, *args):
+    """Start function(*args) in a task unless a task for the key is already
+    in progress, and return the task"""
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(function(*args))
+        inflight[key] = task
+        task.add_done_callback(lambda task: inflight.pop(key, None))
+    return task
 
 
-def gettagkey(tag=None):
-    return 'items:tag:{}'.format(tag or 'none')
+async def coalesce(key, function, *args):
+    """Return the result of function(*args), sharing it with the other
+    callers for the key while it is in progress"""
+    # A cancelled caller leaves the task running for the others
+    return await asyncio.shield(runonce(key, function, *args))
+
+
+async def usecatalog():
+    """Use the catalog being served for the rest of the request and return
+    its version, which is its generation and last update time"""
+    catalog, format_, lastupdated = parsecatalog(await store.get('catalog'))
+    generation.set(catalog)
+    itemformat.set(format_)
+
+    # Pointers stored before they held the last update time
+    if lastupdated is None:
+        lastupdated = await store.get(getcatalogkey('items:lastupdated'))
+
+    return catalog, lastupdated
+
+
+def parsecatalog(catalog):
+    """Return the generation, item format and last update time of a stored
+    catalog pointer"""
+    # Before item formats, the pointer was just the generation
+    if type(catalog) is not dict:
+        return catalog or 0, 1, None
+    return (catalog['generation'], catalog['format'],
+            catalog.get('lastupdated'))
+
+
+def getcatalogkey(key):
+    """Return the key within the current generation of the catalog"""
+    # Generation 0 is the catalog stored before generations were introduced
+    catalog = generation.get()
+    return 'catalog:{}:{}'.format(catalog, key) if catalog else key
 
 
 async def getcurrentuser(request: Request):
@@ -544,94 +973,183 @@ async def getcurrentuser(request: Request):
     if sid:
         userid = await store.get(getsessionkey(sid))
         if userid:
-            user = await getuser(userid)
+            user, lastactive = await asyncio.gather(
+                getuser(userid),
+                store.zscore('users:active', userid)
+            )
+            # Recently active users are refreshed first by updateusers.py,
+            # which only needs their activity to the minute
+            now = time.time()
+            if lastactive is None or now - lastactive > 60:
+                await store.zadd('users:active', {userid: now})
 
     return user
 
 
 async def getuser(steamid, urltype='profiles', create=False):
     if urltype == 'id':
-        steamid = await tf2api.resolvevanityurl(config.apikey, steamid)
+        steamid = await coalesce(('vanityurl', steamid), resolvevanityurl,
+                                 steamid)
 
-    userkey = getuserkey(steamid)
-    user = await store.hgetall(userkey)
+    user = await store.hgetall(getuserkey(steamid))
 
     if user:
-        create = False
-        lastupdate = datetime.fromtimestamp(user['lastupdate'])
-        needsupdate = (datetime.now() - lastupdate) > timedelta(minutes=3)
-    else:
-        if not create:
-            return
-        user = {'id': steamid}
+        # Stale profiles are served while they are refreshed
+        if time.time() - user['lastupdate'] > userrefreshage:
+            refreshuserlater(user)
+        return user
 
-    if create or needsupdate:
-        try:
-            steamuser, backpack = await asyncio.gather(
-                tf2api.getplayersummary(config.apikey, steamid),
-                tf2api.getplayerbackpack(config.apikey, steamid)
-            )
+    if create:
+        return await refreshuser({'id': steamid, 'wishlist': []}, create=True)
+
+
+async def resolvevanityurl(vanityurl):
+    """Return the steamid of a vanity url, which is cached in the store"""
+    key = getvanitykey(vanityurl)
+
+    steamid = await store.get(key)
+    if steamid is None:
+        steamid = await tf2api.resolvevanityurl(config.apikey, vanityurl)
+        # Unknown names are cached as empty for a shorter time
+        await store.setex(key, vanityage if steamid else unknownvanityage,
+                          steamid or '')
 
-        except URLError:
-            # Postpone update if this is not a new user
-            if create:
-                raise
-            return user
+    return steamid or None
 
-        user['name'] = steamuser['personaname']
-        # Remove trailing slash and parse url
-        user['url'] = urlparse(steamuser['profileurl'].rstrip('/')).path
-        user['avatar'] = steamuser['avatar']
-        user['state'] = ('Online' if steamuser['personastate'] != 0 else
-                         'Offline')
 
-        if backpack:
-            items = defaultdict(set)
-            for item in backpack['items']:
-                items[str(item['quality'])].add(item['defindex'])
-            for quality, indexes in items.items():
-                items[quality] = list(indexes)
-            user['items'] = items
+def refreshuserlater(user):
+    """Refresh the profile of a user in the background unless it is already
+    being refreshed"""
+    runonce(('refreshuser', user['id']), refreshstaleuser, user)
 
-        if 'gameid' in steamuser:
-            user['state'] = 'In-Game'
 
-        if 'wishlist' not in user:
-            user['wishlist'] = []
+async def refreshstaleuser(user):
+    lag = time.time() - user['lastupdate'] - userrefreshage
+    try:
+        # Only one worker or updateusers.py refreshes a user at a time, and a
+        # failed refresh is retried once the lease expires
+        if await store.lease(getrefreshkey(user['id']), userrefreshlease):
+            await refreshuser(user)
+            logger.debug(f"Refreshed user {user['id']} {lag:.0f}s after it "
+                         'became stale')
+    except Exception as e:
+        logger.warning(f"Could not refresh user {user['id']}: {e!r}")
 
-        user['lastupdate'] = datetime.now().timestamp()
 
-        async with store.pipeline() as pipe:
-            pipe.hset(userkey, mapping=user)
-            pipe.sadd('users', user['id'])
-            await pipe.execute()
+async def refreshuser(user, create=False):
+    """Fetch the profile of a user from Steam and store it"""
+    steamuser, backpack = await asyncio.gather(
+        tf2api.getplayersummary(config.apikey, user['id']),
+        tf2api.getplayerbackpack(config.apikey, user['id'])
+    )
+
+    profile = getprofile(steamuser)
+    user.update(profile)
+
+    async with store.pipeline() as pipe:
+        # The wishlist of an existing user is only changed by its own route
+        pipe.hset(getuserkey(user['id']), mapping=user if create else profile)
+        pipe.sadd('users', user['id'])
+        setvanityurl(pipe, user['id'], profile)
+        setowneditems(pipe, user['id'], backpack)
+        await pipe.execute()
 
     return user
 
 
+def getprofile(steamuser):
+    """Return the fields of a user from the Steam player summary"""
+    profile = {}
+
+    profile['name'] = steamuser['personaname']
+    # Remove trailing slash and parse url
+    profile['url'] = urlparse(steamuser['profileurl'].rstrip('/')).path
+    profile['avatar'] = steamuser['avatar']
+    profile['state'] = ('Online' if steamuser['personastate'] != 0 else
+                        'Offline')
+
+    if 'gameid' in steamuser:
+        profile['state'] = 'In-Game'
+
+    profile['lastupdate'] = time.time()
+
+    return profile
+
+
+def setvanityurl(pipe, steamid, profile):
+    """Cache the vanity url of a user profile, if it has one"""
+    urltype, _, vanityurl = profile['url'].strip('/').partition('/')
+    if urltype == 'id':
+        pipe.setex(getvanitykey(vanityurl), vanityage, steamid)
+
+
+def setowneditems(pipe, steamid, backpack):
+    """Store the items in a backpack as a bitset of their indexes for each
+    quality, apart from the user so they are only read by the pages that
+    mark them"""
+    # Private backpacks have no items, so the stored ones are kept
+    if not (backpack and 'items' in backpack):
+        return
+
+    items = defaultdict(list)
+    for item in backpack['items']:
+        items[str(item['quality'])].append(item['defindex'])
+
+    key = getownedkey(steamid)
+    pipe.delete(key)
+    for quality, bitset in tf2search.OwnershipIndex(items).tobytes().items():
+        pipe.execute_command('HSET', key, quality, bitset)
+    # Lists of the items stored in the user before the bitsets
+    pipe.hdel(getuserkey(steamid), 'items')
+
+
 def getuserkey(uid):
     return 'user:{}'.format(uid)
 
 
+def getrefreshkey(uid):
+    return 'user:{}:refresh'.format(uid)
+
+
+def getownedkey(uid):
+    return 'user:{}:owned'.format(uid)
+
+
+def getvanitykey(vanityurl):
+    # Vanity urls are case-insensitive
+    return 'vanity:{}'.format(vanityurl.lower())
+
+
 def getsessionkey(sid):
     return 'session:{}'.format(sid)
 
 
+def iteritems(keys):
+    """Return a buffered async iterator over the items with the given keys"""
+    return (store.Values(keys) if itemformat.get() > 1 else
+            store.Hashes(keys))
+
+
 async def getitems(indexes):
-    return await store.hgetall([getitemkey(index) for index in indexes])
+    keys = [getitemkey(index) for index in indexes]
+    if itemformat.get() > 1:
+        return [item or {} for item in await store.mget(keys)]
+    return await store.hgetall(keys)
 
 
 async def getitem(index):
+    if itemformat.get() > 1:
+        return await store.get(getitemkey(index))
     return await store.hgetall(getitemkey(index))
 
 
 async def getitembyslug(slug):
-    index = await store.hget('items:slugs', slug)
+    index = await store.hget(getcatalogkey('items:slugs'), slug)
     return await getitem(index) if index is not None else None
 
 
 def getitemkey(index):
-    return 'item:{}'.format(index)
+    return getcatalogkey('item:{}'.format(index))
 
 
 app.serve_files('static', extensions=get_default_extensions() | {'.map'})
@@ -1,4 +1,4 @@
-from collections import OrderedDict
+import hashlib
 from collections.abc import AsyncIterator, Hashable, Sized, Mapping
 
 import orjson
@@ -13,6 +13,11 @@ def mdumps(d):
     return {k: dumps(v) for k, v in d.items()}
 
 
+def digest(obj):
+    return hashlib.blake2b(orjson.dumps(obj, option=orjson.OPT_SORT_KEYS),
+                           digest_size=16).hexdigest()
+
+
 def loads(s):
     if s is not None:
         return orjson.loads(s)
@@ -28,9 +33,19 @@ class Redis(_Redis):
     def setex(self, key, time, value):
         return super().setex(key, time, dumps(value))
 
+    async def lease(self, key, seconds):
+        """Hold the key for the given seconds unless another client already
+        does, and return whether it is now held"""
+        return bool(await super().set(key, b'', nx=True, ex=seconds))
+
     def mset(self, map_):
         return super().mset(mdumps(map_))
 
+    async def mget(self, keys):
+        if not keys:
+            return []
+        return [loads(v) for v in await super().mget(keys)]
+
     async def hget(self, *args, **kwargs):
         return loads(await super().hget(*args, **kwargs))
 
@@ -66,6 +81,11 @@ class Redis(_Redis):
         else:
             return loads(await self._hgetall(key))
 
+    async def hgetallbytes(self, key):
+        """Return the fields of a hash whose values are not JSON"""
+        return {k.decode(): v
+                for k, v in (await super().hgetall(key)).items()}
+
     def hset(self, name, key=None, value=None, mapping=None):
         return super().hset(
             name, key,
@@ -89,14 +109,16 @@ class Redis(_Redis):
     async def lrange(self, *args, **kwargs):
         return (e.decode() for e in await super().lrange(*args, **kwargs))
 
-    async def delete_all(self, match, count=100):
+    async def unlink_all(self, match, count=1000):
+        """Remove the keys matching the pattern, leaving the server to
+        reclaim their memory in the background"""
         cursor = None
         while cursor != 0:
             if cursor is None:
                 cursor = 0
             cursor, keys = await self.scan(cursor, match, count)
             if keys:
-                await self.delete(*keys)
+                await self.unlink(*keys)
 
     def pipeline(self, transaction=True, shard_hint=None):
         return Pipeline(
@@ -110,15 +132,22 @@ class Redis(_Redis):
     def Hashes(self, *args, **kwargs):
         return Hashes(self, *args, **kwargs)
 
+    def Values(self, *args, **kwargs):
+        return Values(self, *args, **kwargs)
+
     def HashSet(self, *args, **kwargs):
         return HashSet(self, *args, **kwargs)
 
-    async def SearchHashSet(self, *args, **kwargs):
-        return await SearchHashSet.create(self, *args, **kwargs)
-
 
 class Pipeline(_Pipeline, Redis):
-    pass
+    async def execute_batch(self, size):
+        """Execute the queued commands if there are at least size of them
+        and return the number of commands sent"""
+        count = len(self)
+        if count < size:
+            return 0
+        await self.execute()
+        return count
 
 
 class Hash(Hashable, Mapping):
@@ -162,7 +191,7 @@ class Hashes(AsyncIterator, Sized):
         if self.i >= len(self.keys):
             raise StopAsyncIteration
         if self.i % self.bufsize == 0:
-            self.results = await self.r.hgetall(
+            self.results = await self._getall(
                 self.keys[self.i:self.i + self.bufsize]
             )
         return self.results[self.i % self.bufsize]
@@ -170,6 +199,15 @@ class Hashes(AsyncIterator, Sized):
     def __len__(self):
         return len(self.keys)
 
+    def _getall(self, keys):
+        return self.r.hgetall(keys)
+
+
+class Values(Hashes):
+    """This class enables buffered iteration over a list of values."""
+    def _getall(self, keys):
+        return self.r.mget(keys)
+
 
 class HashSet(Mapping):
     def __init__(self, redis, key, tokey, sortkey=None):
@@ -193,55 +231,3 @@ class HashSet(Mapping):
     async def __len__(self):
         return await self.r.scard(self.key)
 
-
-class SearchHashSet(HashSet):
-    """This class optimizes search on a set of hashes by first obtaining
-    and storing all the fields necessary for search, allowing faster access
-    to them. Other fields are accessed as required from the store."""
-    class SearchHash(Hash):
-        def __init__(self, key, member, set_):
-            super().__init__(set_.r, key)
-            self.member = member
-            self.set_ = set_
-
-        def __getitem__(self, field):
-            if field in self.set_.fields:
-                return self.set_._gethashfield(self, field)
-            else:
-                return super().__getitem__(field)
-
-    @classmethod
-    async def create(cls, redis, key, tokey, fields, sortkey=None):
-        self = cls(redis, key, tokey)
-        self.fields = fields
-
-        get = ('#',) + tuple('{}->{}'.format(tokey('*'), f) for f in fields)
-        self.result = tuple(await self.r.sort(key, get=get))
-
-        hashes = []
-        for i in range(0, len(self.result), len(fields) + 1):
-            hashes.append((self.result[i].decode(), i + 1))
-
-        if sortkey:
-            hashes.sort(key=lambda k: sortkey(k[0]))
-            self.hashes = OrderedDict(hashes)
-        else:
-            self.hashes = dict(hashes)
-
-        return self
-
-    def __getitem__(self, member):
-        return self.SearchHash(self.tokey(member), str(member), self)
-
-    def __contains__(self, member):
-        return str(member) in self.hashes
-
-    def __iter__(self):
-        yield from self.hashes
-
-    def __len__(self):
-        return len(self.hashes)
-
-    def _gethashfield(self, hash_, field):
-        i = self.hashes[hash_.member] + self.fields.index(field)
-        return loads(self.result[i])
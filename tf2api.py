@@ -6,23 +6,74 @@ You can also obtain market prices from backpack.tf.
 There are also functions for parsing the information of each item.
 
 """
+import os
+import re
+import time
 import asyncio
-import json
+import hashlib
 from collections import defaultdict, OrderedDict
+from pathlib import Path
 
 import aiohttp
 
+try:
+    from orjson import dumps as _dumps, loads as _loads
+except ImportError:
+    from json import dumps as _jsondumps, loads as _loads
 
-async def getschema(apikey):
-    """Return the schema"""
-    schema_task = asyncio.create_task(_getschemaoverview(apikey))
+    def _dumps(obj):
+        return _jsondumps(obj).encode()
+
+_headers = {'User-Agent': 'tf2api'}
+
+_session = None
+
+_schemacursors = [0]
+
+
+async def getschema(apikey, cache=None, concurrency=8):
+    """Return the schema. The pages of items are requested concurrently,
+    up to concurrency at a time, at the start cursors seen in the previous
+    call (or saved in cache). Only the pages found by following each page's
+    next cursor are used, so a changed schema is still read correctly."""
+    schema_task = asyncio.create_task(_getschemaoverview(apikey, cache))
+
+    semaphore = asyncio.Semaphore(concurrency)
+    pages = {}
+
+    async def getpage(start):
+        async with semaphore:
+            return await _getschemaitems(apikey, start, cache)
+
+    def fetch(start):
+        if start not in pages:
+            pages[start] = asyncio.create_task(getpage(start))
+        return pages[start]
+
+    cursors = ((cache.load('schemacursors') if cache is not None else None) or
+               _schemacursors)
+    for start in cursors:
+        fetch(start)
 
     all_items = []
+    cursors = []
 
     start = 0
-    while start is not None:
-        items, start = await _getschemaitems(apikey, start)
-        all_items.extend(items)
+    try:
+        while start is not None:
+            items, next_ = await fetch(start)
+            all_items.extend(items)
+            cursors.append(start)
+            start = next_
+    finally:
+        # Discard any pages requested at cursors which are no longer used
+        for task in pages.values():
+            task.cancel()
+        await asyncio.gather(*pages.values(), return_exceptions=True)
+
+    _schemacursors[:] = cursors
+    if cache is not None:
+        cache.save('schemacursors', cursors)
 
     schema = await schema_task
     schema['result']['items'] = all_items
@@ -30,20 +81,21 @@ async def getschema(apikey):
     return schema
 
 
-async def _getschemaoverview(apikey):
+async def _getschemaoverview(apikey, cache=None):
     url = ('https://api.steampowered.com/IEconItems_440/GetSchemaOverview/v1/'
            f'?key={apikey}&language=en')
-    return await _getjsonresponse(url)
+    return await _getjsonresponse(url, cache, 'schema')
 
 
-async def _getschemaitems(apikey, start):
+async def _getschemaitems(apikey, start, cache=None):
     url = ('https://api.steampowered.com/IEconItems_440/GetSchemaItems/v1/'
            f'?key={apikey}&language=en&start={start}')
-    result = (await _getjsonresponse(url))['result']
+    result = (await _getjsonresponse(url, cache, 'schema'))['result']
     return result['items'], result.get('next')
 
 
-async def getitemsinfo(apikey, storeprices, indexes):
+async def getitemsinfo(apikey, storeprices, indexes, cache=None,
+                       source='itemsinfo'):
     """Return a dictionary of AssetClassInfo values with defindex as key"""
     url = ('https://api.steampowered.com/ISteamEconomy/GetAssetClassInfo/v0001/'
            '?key={0}&language=en&appid=440&class_count={1}'.format(apikey,
@@ -54,18 +106,18 @@ async def getitemsinfo(apikey, storeprices, indexes):
         classid = storeprices[index]['classid']
         url += '&classid{0}={1}'.format(n, classid)
 
-    infobyid = (await _getjsonresponse(url))['result']
+    infobyid = (await _getjsonresponse(url, cache, source))['result']
     del infobyid['success']
 
     return {int(iteminfo['app_data']['def_index']): iteminfo
             for iteminfo in infobyid.values()}
 
 
-async def getbundles(apikey, storeprices):
+async def getbundles(apikey, storeprices, cache=None):
     """Return a dictionary of store bundles with defindex as key"""
     indexes = [index for index, price in storeprices.items()
                if not {'Bundles', 'Class_Bundles'}.isdisjoint(price['tags'])]
-    return await getitemsinfo(apikey, storeprices, indexes)
+    return await getitemsinfo(apikey, storeprices, indexes, cache, 'bundles')
 
 
 def getitemsets(schema):
@@ -108,13 +160,14 @@ def getparticleeffects(schema):
             schema['result']['attribute_controlled_attached_particles']}
 
 
-async def getstoreprices(apikey):
+async def getstoreprices(apikey, cache=None):
     """Return a dictionary of store prices where the key is defindex for
     each item"""
     url = ('https://api.steampowered.com/ISteamEconomy/GetAssetPrices/v0001/'
            '?key={}&language=en&appid=440&currency=usd'.format(apikey))
 
-    prices = (await _getjsonresponse(url))['result']['assets']
+    prices = (await _getjsonresponse(url, cache, 'storeprices'))['result'][
+        'assets']
 
     return {int(price['name']): price for price in prices}
 
@@ -125,14 +178,15 @@ def getnewstoreprices(storeprices):
             if 'New' in price['tags']}
 
 
-async def getbackpackprices(apikey, items, itemsbyname):
+async def getbackpackprices(apikey, items, itemsbyname, cache=None):
     """Get market prices from backpack.tf.
     Return a dictionary where the key is defindex and value is a dictionary of
     prices for the item"""
     url = ('https://backpack.tf/api/IGetPrices/v4/'
            '?key={}&compress=1'.format(apikey))
 
-    pricesdata = (await _getjsonresponse(url))['response']['items']
+    pricesdata = (await _getjsonresponse(url, cache, 'backpackprices'))[
+        'response']['items']
 
     pricesdict = defaultdict(dict)
 
@@ -399,8 +453,125 @@ async def resolvevanityurl(apikey, vanityurl):
         return response['steamid']
 
 
-async def _getjsonresponse(url):
-    headers = {'User-Agent': 'tf2api'}
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(url) as response:
-            return json.loads((await response.read()).decode())
+async def opensession(limit=100, limit_per_host=0, ttl_dns_cache=300,
+                      keepalive_timeout=30, timeout=60):
+    """Open an HTTP session that is shared by all API calls until
+    closesession is called. Its connections are kept alive and reused, and
+    DNS lookups are cached for ttl_dns_cache seconds. Without a shared
+    session, a new one is created for each call."""
+    global _session
+    await closesession()
+    connector = aiohttp.TCPConnector(limit=limit,
+                                     limit_per_host=limit_per_host,
+                                     ttl_dns_cache=ttl_dns_cache,
+                                     keepalive_timeout=keepalive_timeout)
+    _session = aiohttp.ClientSession(
+        connector=connector, headers=_headers,
+        timeout=aiohttp.ClientTimeout(total=timeout)
+    )
+
+
+async def closesession():
+    """Close the shared HTTP session if one is open"""
+    global _session
+    if _session is not None:
+        session, _session = _session, None
+        await session.close()
+
+
+class ResponseCache:
+    """A cache of API responses stored in a directory. Cached responses are
+    revalidated with conditional requests when the API gave an ETag or
+    Last-Modified header, and are used without a request for maxage seconds
+    (or the max-age given by the API, if longer) after being fetched.
+
+    The name of each source whose response differs from the cached one is
+    added to the changed set."""
+    def __init__(self, path, maxage=0):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.maxage = maxage
+        self.changed = set()
+
+    async def get(self, session, url, source):
+        """Return the decoded response of url using the cache"""
+        key = hashlib.sha256(url.encode()).hexdigest()
+        bodypath = self.path / f'{key}.json'
+        meta = self.load(key) if bodypath.exists() else None
+
+        if meta and (time.time() - meta['fetched'] <
+                     max(self.maxage, meta['maxage'])):
+            return _loads(bodypath.read_bytes())
+
+        headers = {}
+        if meta and meta['etag']:
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta['lastmodified']:
+            headers['If-Modified-Since'] = meta['lastmodified']
+
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304 and meta:
+                body = bodypath.read_bytes()
+            else:
+                body = await response.read()
+
+            if response.status not in (200, 304):
+                return _loads(body)
+
+            maxage = re.search(r'max-age=(\d+)',
+                               response.headers.get('Cache-Control', ''))
+
+            meta = {'etag': response.headers.get('ETag'),
+                    'lastmodified': response.headers.get('Last-Modified'),
+                    'maxage': int(maxage.group(1)) if maxage else 0,
+                    'fetched': time.time(),
+                    'digest': meta['digest'] if meta else None}
+
+        if self.update(source, key, body, meta):
+            self._write(bodypath, body)
+
+        return _loads(body)
+
+    def update(self, source, key, body, meta=None):
+        """Save the metadata of a response and return True if its body
+        differs from the previous one, in which case source is marked as
+        changed"""
+        meta = meta or self.load(key) or {}
+        digest = hashlib.sha256(body).hexdigest()
+        changed = meta.get('digest') != digest
+        if changed:
+            self.changed.add(source)
+        self.save(key, dict(meta, digest=digest))
+        return changed
+
+    def load(self, name):
+        """Return the data saved under name, if any"""
+        path = self.path / f'{name}.meta'
+        if path.exists():
+            return _loads(path.read_bytes())
+
+    def save(self, name, data):
+        """Save a small JSON serializable value under name"""
+        self._write(self.path / f'{name}.meta', _dumps(data))
+
+    @staticmethod
+    def _write(path, data):
+        # Write to a temporary file first so that an interrupted run does
+        # not leave a truncated response behind
+        temppath = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        temppath.write_bytes(data)
+        os.replace(temppath, path)
+
+
+async def _getjsonresponse(url, cache=None, source=None):
+    if _session is not None:
+        return await _getjson(_session, url, cache, source)
+    async with aiohttp.ClientSession(headers=_headers) as session:
+        return await _getjson(session, url, cache, source)
+
+
+async def _getjson(session, url, cache=None, source=None):
+    if cache is not None:
+        return await cache.get(session, url, source)
+    async with session.get(url) as response:
+        return _loads(await response.read())
@@ -16,6 +16,8 @@ Note: You must provide your own image URLs for paint cans and blueprints.
 import re
 import json
 import asyncio
+from array import array
+from bisect import bisect_left, bisect_right
 from fractions import Fraction
 from collections import namedtuple, defaultdict, OrderedDict
 
@@ -30,16 +32,24 @@ DENOMREGEX = (r'(keys?|'
 
 PRICEREGEX = (r'(?:(\d+(?:\.\d+)?) ?{})'.format(DENOMREGEX))
 
+TF2SOURCES = ('schema', 'storeprices', 'bundles', 'backpackprices',
+              'blueprints')
+
+SPECIALCHARS = frozenset('.^$*+?{}[]\\|()')
+
 QUALITYREGEX = r'({}|collector|collectors|dirty|uncraft(?:able)?)'.format(
     '|'.join(i.lower() for i in tf2api.getallqualities().values()))
 
 
-async def gettf2info(apikey, backpackkey, blueprintsfilename):
+async def gettf2info(apikey, backpackkey, blueprintsfilename, cache=None):
     """Return a named tuple which contains information from multiple sources
-    about TF2 items"""
+    about TF2 items. If a tf2api.ResponseCache is given, it is used for the
+    API responses, and changed contains the names of the sources which
+    changed since they were last cached. Otherwise, it contains all of
+    them."""
     schema, storeprices = await asyncio.gather(
-        tf2api.getschema(apikey),
-        tf2api.getstoreprices(apikey)
+        tf2api.getschema(apikey, cache),
+        tf2api.getstoreprices(apikey, cache)
     )
 
     items = tf2api.getitems(schema)
@@ -51,23 +61,29 @@ async def gettf2info(apikey, backpackkey, blueprintsfilename):
     newstoreprices = tf2api.getnewstoreprices(storeprices)
 
     bundles, backpackprices = await asyncio.gather(
-        tf2api.getbundles(apikey, storeprices),
-        tf2api.getbackpackprices(backpackkey, items, itemsbyname)
+        tf2api.getbundles(apikey, storeprices, cache),
+        tf2api.getbackpackprices(backpackkey, items, itemsbyname, cache)
     )
 
-    with open(blueprintsfilename, encoding='utf-8') as f:
-        data = json.loads(f.read())
-    blueprints = _parseblueprints(data, itemsbyname)
+    with open(blueprintsfilename, 'rb') as f:
+        data = f.read()
+    blueprints = _parseblueprints(json.loads(data), itemsbyname)
+
+    if cache is not None:
+        cache.update('blueprints', 'blueprints', data)
+        changed = frozenset(cache.changed)
+    else:
+        changed = frozenset(TF2SOURCES)
 
     fields = ('items itemsbyname itemsets attributes effects '
               'blueprints storeprices newstoreprices bundles '
-              'backpackprices')
+              'backpackprices changed')
 
     TF2Info = namedtuple('TF2Info', fields)
 
     return TF2Info(items, itemsbyname, itemsets, attributes, effects,
                    blueprints, storeprices, newstoreprices, bundles,
-                   backpackprices)
+                   backpackprices, changed)
 
 
 def getitemsdict(tf2info):
@@ -78,10 +94,14 @@ def getitemsdict(tf2info):
     return itemsdict
 
 
-def search(query, itemsdict, nametoindexmap, itemsets, bundles, pricesource):
+def search(query, itemsdict, nametoindexmap, itemsets, bundles, pricesource,
+           wordindex=None, classtagindex=None, priceindex=None, rank=False):
     """This function parses the query using parseinput and gets all the
     items that match it. It returns a list of dicts obtained from
-    getsearchresult"""
+    getsearchresult. A WordIndex, ClassTagIndex and PriceIndex (of
+    pricesource) of itemsdict can be given to avoid scanning every item in
+    word, class/tag and price searches. If rank is true, the items of a
+    price search of all items are ordered by their price."""
     input_ = parseinput(query)
     query = input_['query']
     querylist = input_['querylist']
@@ -105,7 +125,8 @@ def search(query, itemsdict, nametoindexmap, itemsets, bundles, pricesource):
         priceinput = parseinput(words or '')
         priceclasses, pricetags = priceinput['classes'], priceinput['tags']
         if priceclasses or pricetags:
-            results = _classtagsearch(priceclasses, pricetags, itemsdict)
+            results = _classtagsearch(priceclasses, pricetags, itemsdict,
+                                      classtagindex)
         elif words:
             pricematch = None
 
@@ -114,7 +135,7 @@ def search(query, itemsdict, nametoindexmap, itemsets, bundles, pricesource):
     indexes = query.split() if indexmatch else []
 
     if classes or tags:
-        results = _classtagsearch(classes, tags, itemsdict)
+        results = _classtagsearch(classes, tags, itemsdict, classtagindex)
 
     elif query == 'sets':
         # Get all the item sets and their items
@@ -141,11 +162,13 @@ def search(query, itemsdict, nametoindexmap, itemsets, bundles, pricesource):
 
         if priceclasses or pricetags:
             title = results[0]['title'] if results else None
+            _pricefilter(quality, criteria, amount, denom, results,
+                         pricesource, priceindex)
         else:
             title = None
             results = [getsearchresult(items=itemsdict.values())]
-
-        _pricefilter(quality, criteria, amount, denom, results, pricesource)
+            _pricefilter(quality, criteria, amount, denom, results,
+                         pricesource, priceindex, itemsdict, rank)
 
         if results and title:
             results[0]['title'] = '{} — {}'.format(results[0]['title'], title)
@@ -162,7 +185,7 @@ def search(query, itemsdict, nametoindexmap, itemsets, bundles, pricesource):
 
     else:
         # Regular word search
-        result = _wordsearch(query, querylist, itemsdict)
+        result = _wordsearch(query, querylist, itemsdict, wordindex)
         results = [result] if result else []
 
         # Check if there's a match between an item set name and query
@@ -172,12 +195,11 @@ def search(query, itemsdict, nametoindexmap, itemsets, bundles, pricesource):
     return results
 
 
-def visualizeprice(query, itemsdict, pricesource):
-    """Return a list of items representing a price if parsed from the query"""
-    query = parseinput(query)['query']
-    pricevizmatch = re.match(
-        r'{}(?: (?:in|to) {})?$'.format(PRICEREGEX, DENOMREGEX),
-        query.lower())
+def visualizeprice(query, itemsdict, pricesource, denomtable=None):
+    """Return a list of items representing a price if parsed from the query.
+    A denomination table from loaddenomtable can be given to avoid computing
+    it from the market prices in itemsdict"""
+    pricevizmatch = _getpricevizmatch(query)
 
     if pricevizmatch:
         amount = pricevizmatch.group(1)
@@ -185,7 +207,7 @@ def visualizeprice(query, itemsdict, pricesource):
         todenom = _getdenom(pricevizmatch.group(3) or '')
 
         items = _getpriceasitems(amount, denom, todenom,
-                                 itemsdict, pricesource)
+                                 itemsdict, pricesource, denomtable)
 
         titlelist = [_getpricestring(item['count'], item['denom'])
                      for item in items]
@@ -199,6 +221,29 @@ def visualizeprice(query, itemsdict, pricesource):
         return [getsearchresult(title, 'price', items)] if items else []
 
 
+def ispricevisualization(query):
+    """Check if the query is for visualizing a price"""
+    return _getpricevizmatch(query) is not None
+
+
+def getdenomtable(itemsdict, pricesource):
+    """Return a mapping to convert between denominations, using the market
+    prices of the denomination items in itemsdict, that can be stored as
+    JSON. Exact values are kept as fraction strings."""
+    return {from_: {to: str(value) if type(value) is Fraction else value
+                    for to, value in values.items()}
+            for from_, values in _getdenomvalues(itemsdict,
+                                                 pricesource).items()}
+
+
+def loaddenomtable(table):
+    """Return a mapping to convert between denominations from a table
+    returned by getdenomtable"""
+    return {from_: {to: Fraction(value) if type(value) is str else value
+                    for to, value in values.items()}
+            for from_, values in table.items()}
+
+
 def createitemdict(index, tf2info):
     """Take a TF2 item and return a custom dict with a limited number of
     keys that are used for search"""
@@ -268,6 +313,32 @@ def createitemdict(index, tf2info):
     return itemdict
 
 
+def getpricetable(marketprices):
+    """Return a table of the parsed prices in a dict of index to market
+    prices for each price source. Each source has columns of the index,
+    quality, craftability, low and high values and denomination of each
+    price."""
+    columns = ('index', 'quality', 'craftable', 'low', 'high', 'denom')
+    table = {}
+
+    for index, marketprice in marketprices.items():
+        for source, prices in marketprice.items():
+            if source not in table:
+                table[source] = {column: [] for column in columns}
+
+            for quality, price in (prices or {}).items():
+                p = price.split()
+                low = float(p[0])
+                high = float(p[2]) if len(p) == 4 else low
+
+                row = (index, quality, quality != 'Uncraftable', low, high,
+                       p[-1].rstrip('s'))
+                for column, value in zip(columns, row):
+                    table[source][column].append(value)
+
+    return table
+
+
 def getsearchresult(title='', type='', items=None):
     """Return a dict containing a group of items used for search results"""
     return {'title': title, 'type': type, 'items': items or []}
@@ -347,7 +418,7 @@ def foldaccents(string: str):
     return string.translate(accents)
 
 
-def _classtagsearch(classes, tags, itemsdict):
+def _classtagsearch(classes, tags, itemsdict, classtagindex=None):
     """Search for items that match classes and tags"""
     results = defaultdict(list)
     names = set()
@@ -361,7 +432,13 @@ def _classtagsearch(classes, tags, itemsdict):
     # Check if the weapon tag is specified (eg. primary, melee)
     hasweapontag = not tags.isdisjoint(tf2api.getweapontags())
 
-    for itemdict in itemsdict.values():
+    if classtagindex:
+        itemdicts = (itemsdict[key] for key in
+                     classtagindex.getmatches(classes, tags))
+    else:
+        itemdicts = itemsdict.values()
+
+    for itemdict in itemdicts:
         itemclasses = itemdict['classes']
         itemtags = itemdict['tags']
         # Gives a match if there's an intersection between the item's
@@ -396,7 +473,7 @@ def _classtagsearch(classes, tags, itemsdict):
     return results
 
 
-def _wordsearch(query, querylist, itemsdict):
+def _wordsearch(query, querylist, itemsdict, wordindex=None):
     """Search for items whose names match query"""
     items = []
     names = set()
@@ -406,7 +483,14 @@ def _wordsearch(query, querylist, itemsdict):
     else:
         pattern = r'\b{}\b'.format(querylist[0])
 
-    for itemdict in itemsdict.values():
+    if wordindex:
+        itemdicts = (itemsdict[key] for key in
+                     wordindex.getcandidates(query, querylist)
+                     if key in itemsdict)
+    else:
+        itemdicts = itemsdict.values()
+
+    for itemdict in itemdicts:
         name = foldaccents(itemdict['name'])
 
         if query:
@@ -430,6 +514,327 @@ def _wordsearch(query, querylist, itemsdict):
             items=_getsorteditemlist(items, querylist, query))
 
 
+class WordIndex:
+    """An inverted index of the item names in an items dictionary. It maps
+    each word of a folded name to the positions of the items which have it,
+    and each trigram of a folded name (in its original and lowercase forms)
+    to the items which contain it. Looking up a query returns a superset of
+    the items that _wordsearch would match, in their original order."""
+    def __init__(self, itemsdict):
+        self.keys = []
+        self.words = defaultdict(list)
+        self.trigrams = defaultdict(list)
+
+        for i, (key, itemdict) in enumerate(itemsdict.items()):
+            name = foldaccents(itemdict['name'])
+            self.keys.append(key)
+
+            for word in set(_splitspecial(name)):
+                self.words[word].append(i)
+
+            for trigram in _gettrigrams(name) | _gettrigrams(name.lower()):
+                self.trigrams[trigram].append(i)
+
+    def getcandidates(self, query, querylist):
+        """Return the keys of the items that may match a query, where
+        querylist is the set of words (or the pattern of a quoted query)
+        used by _wordsearch"""
+        if query:
+            positions = set()
+            for word in querylist:
+                positions.update(self.words.get(word, ()))
+            if len(query) > 2:
+                positions.update(self._getsubstringcandidates(query))
+        else:
+            # A quoted query is matched as a regular expression, so only
+            # plain text can be looked up as a substring of the names
+            pattern = querylist[0]
+            if len(pattern) > 2 and not SPECIALCHARS.intersection(pattern):
+                positions = self._getsubstringcandidates(pattern)
+            else:
+                positions = range(len(self.keys))
+
+        return [self.keys[i] for i in sorted(positions)]
+
+    def _getsubstringcandidates(self, string):
+        """Return the positions of the items whose names may contain string"""
+        postings = sorted((self.trigrams.get(trigram, ())
+                           for trigram in _gettrigrams(string)), key=len)
+        positions = set(postings[0])
+        for posting in postings[1:]:
+            if not positions:
+                break
+            positions.intersection_update(posting)
+        return positions
+
+
+class SuggestionIndex:
+    """An index of item names used to suggest items as a query is typed.
+    Names are folded and lowercased, and suggestions are ordered by how well
+    they match: names starting with the query come first, then names with a
+    word starting with it, then names containing it anywhere."""
+    def __init__(self, names, descriptions, paths):
+        self.suggestions = list(zip(names, descriptions, paths))
+        self.names = [foldaccents(name).lower() for name in names]
+        self.prefixes = sorted((name, i) for i, name in enumerate(self.names))
+        self.words = sorted({(word, i) for i, name in enumerate(self.names)
+                             for word in _splitspecial(name)})
+        self.trigrams = defaultdict(list)
+
+        for i, name in enumerate(self.names):
+            for trigram in _gettrigrams(name):
+                self.trigrams[trigram].append(i)
+
+    def get(self, query, limit=10):
+        """Return lists of names, descriptions and paths of the items that
+        match query, limited to the most relevant ones"""
+        query = foldaccents(query).lower()
+        positions = OrderedDict()
+
+        if query:
+            for entries in (self.prefixes, self.words):
+                j = bisect_left(entries, (query,))
+                while j < len(entries) and len(positions) < limit:
+                    key, i = entries[j]
+                    if not key.startswith(query):
+                        break
+                    positions[i] = None
+                    j += 1
+
+            if len(positions) < limit and len(query) > 2:
+                postings = sorted((self.trigrams.get(trigram, ())
+                                   for trigram in _gettrigrams(query)),
+                                  key=len)
+                candidates = set(postings[0]).intersection(*postings[1:])
+                for i in sorted(candidates):
+                    if len(positions) >= limit:
+                        break
+                    if query in self.names[i]:
+                        positions[i] = None
+
+        suggestions = [self.suggestions[i] for i in positions]
+
+        return tuple(list(i) for i in zip(*suggestions)) or ([], [], [])
+
+
+class ClassTagIndex:
+    """A bitmap index of the classes and tags of the items in an items
+    dictionary. Each class and tag, and the groups of multi-class and
+    all-class items, map to an int with the bit at each item's position set
+    if the item belongs to it. Only valid results (in the non-strict sense)
+    are indexed, and the first item of each name that is not obsolete is
+    marked as its canonical item, like the class and tag sets in the store
+    (assuming the items are in schema order)."""
+    def __init__(self, itemsdict):
+        self.keys = list(itemsdict)
+
+        classes = defaultdict(list)
+        tags = defaultdict(list)
+        multi = []
+        allclass = []
+        valid = []
+        canonical = []
+
+        names = set()
+        duplicates = tf2api.getobsoleteindexes()
+
+        for i, itemdict in enumerate(itemsdict.values()):
+            # Obsolete items don't take the name from the items after them
+            name = itemdict['name']
+            iscanonical = (name not in names and
+                           itemdict['index'] not in duplicates)
+            if iscanonical:
+                names.add(name)
+
+            if not isvalidresult(itemdict, False):
+                continue
+
+            valid.append(i)
+            for class_ in itemdict['classes']:
+                classes[class_].append(i)
+            for tag in itemdict['tags']:
+                tags[tag].append(i)
+            if len(itemdict['classes']) > 1:
+                multi.append(i)
+            elif not itemdict['classes']:
+                allclass.append(i)
+            if iscanonical:
+                canonical.append(i)
+
+        self.classes = {k: _getbitset(v) for k, v in classes.items()}
+        self.tags = {k: _getbitset(v) for k, v in tags.items()}
+        self.multi = _getbitset(multi)
+        self.allclass = _getbitset(allclass)
+        self.valid = _getbitset(valid)
+        self.canonical = _getbitset(canonical)
+
+    def getmatches(self, classes, tags):
+        """Return the keys of the valid items that match classes and tags in
+        the same way as _classtagsearch, in their original order"""
+        bitset = self.valid
+
+        if classes:
+            bitset &= self._getunion(self.classes, classes) | self.allclass
+
+        if tags.isdisjoint(tf2api.getweapontags()):
+            if tags:
+                bitset &= self._getunion(self.tags, tags)
+        else:
+            for tag in tags:
+                bitset &= self.tags.get(tag, 0)
+
+        if 'tournament' not in tags:
+            bitset &= ~self.tags.get('tournament', 0)
+
+        return self._getkeys(bitset)
+
+    def getresults(self, classes, tags):
+        """Return the keys of the canonical items for classes and tags,
+        followed by those of the multi-class and all-class items that match
+        tags, in their original order"""
+        remove = 0
+
+        classbitset = (self._getunion(self.classes, classes) if classes else
+                       self.canonical)
+
+        # Get only the specified weapon types
+        if 'weapon' in tags and not tags.isdisjoint(tf2api.getweapontags()):
+            tags = tags - {'weapon'}
+            remove |= self.tags.get('token', 0)
+
+        tagbitset = (self._getunion(self.tags, tags) if tags else
+                     self.canonical)
+
+        # Hide medals if not explicitly searching for them
+        if 'tournament' not in tags:
+            remove |= self.tags.get('tournament', 0)
+
+        classbitset &= self.canonical
+        tagbitset &= self.canonical & ~remove
+
+        bitset = classbitset & tagbitset
+        multibitset = bitset & self.multi
+        allbitset = tagbitset & self.allclass
+        bitset &= ~(multibitset | allbitset)
+
+        return (self._getkeys(bitset), self._getkeys(multibitset),
+                self._getkeys(allbitset))
+
+    @staticmethod
+    def _getunion(bitsets, names):
+        bitset = 0
+        for name in names:
+            bitset |= bitsets.get(name, 0)
+        return bitset
+
+    def _getkeys(self, bitset):
+        return [self.keys[i] for i in _getpositions(bitset)]
+
+
+class OwnershipIndex:
+    """An index of the items owned in each quality, such as those in a
+    backpack, kept as bitsets of their indexes so that the ones on a page are
+    found with an intersection per quality"""
+    def __init__(self, owned):
+        self.qualities = {quality: _getbitset(indexes)
+                          for quality, indexes in owned.items()}
+
+    @classmethod
+    def frombytes(cls, qualities):
+        """Return the index of the bitsets from tobytes"""
+        index = cls({})
+        index.qualities = {quality: int.from_bytes(bitset, 'little')
+                           for quality, bitset in qualities.items()}
+        return index
+
+    def tobytes(self):
+        """Return the bitset of each quality as bytes, for storing"""
+        return {quality: bitset.to_bytes((bitset.bit_length() + 7) // 8,
+                                         'little')
+                for quality, bitset in self.qualities.items()}
+
+    @staticmethod
+    def getbitset(indexes):
+        """Return the bitset of item indexes that getowned takes"""
+        return _getbitset(indexes)
+
+    def getowned(self, bitset):
+        """Return the indexes of the items in the bitset that are owned, by
+        quality"""
+        owned = {}
+        for quality, ownedbitset in self.qualities.items():
+            ownedbitset &= bitset
+            if ownedbitset:
+                owned[quality] = _getpositions(ownedbitset)
+        return owned
+
+
+class PriceIndex:
+    """An index of the prices in a price source's table from getpricetable.
+    The prices of each quality and denomination are kept in arrays sorted by
+    their low and high values, so the items with prices above, below or
+    equal to an amount are found with a binary search."""
+    def __init__(self, table, keys=None):
+        groups = defaultdict(list)
+
+        # Unranked keys are returned in the order of keys, or of the table
+        self.positions = {key: i for i, key in enumerate(
+            OrderedDict.fromkeys(table['index']) if keys is None else keys)}
+
+        for index, quality, low, high, denom in zip(
+                table['index'], table['quality'], table['low'],
+                table['high'], table['denom']):
+            groups[quality, denom].append((low, high, index))
+
+        self.qualities = defaultdict(list)
+        self.prices = {}
+
+        for (quality, denom), prices in groups.items():
+            bylow = sorted(prices)
+            byhigh = sorted(prices, key=lambda k: (k[1], k[0]))
+            self.qualities[quality].extend(i for _, _, i in bylow)
+            self.prices[quality, denom] = (
+                array('d', (low for low, _, _ in bylow)),
+                [i for _, _, i in bylow],
+                array('d', (high for _, high, _ in byhigh)),
+                [i for _, _, i in byhigh]
+            )
+
+    def getkeys(self, quality, denom=None, criteria=None, amount=None,
+                ranked=True):
+        """Return the keys of the items with a price for quality. If denom
+        is given, only prices in it where the low or high value is less than
+        (<), greater than (>) or equal to amount are included. The keys are
+        ordered by value within each denomination if ranked, and otherwise
+        in the order of the keys the index was created with."""
+        if denom is None:
+            matches = list(self.qualities.get(quality, ()))
+        elif (quality, denom) not in self.prices:
+            matches = []
+        else:
+            lows, lowkeys, highs, highkeys = self.prices[quality, denom]
+
+            if criteria == '<':
+                matches = (lowkeys[:bisect_left(lows, amount)] +
+                           highkeys[:bisect_left(highs, amount)])
+            elif criteria == '>':
+                matches = (highkeys[bisect_right(highs, amount):] +
+                           lowkeys[bisect_right(lows, amount):])
+            else:
+                matches = (lowkeys[bisect_left(lows, amount):
+                                   bisect_right(lows, amount)] +
+                           highkeys[bisect_left(highs, amount):
+                                    bisect_right(highs, amount)])
+
+            matches = list(OrderedDict.fromkeys(matches))
+
+        if not ranked:
+            last = len(self.positions)
+            matches.sort(key=lambda key: self.positions.get(key, last))
+
+        return matches
+
+
 def _bundlesearch(query, bundles, nametoindexmap, itemsdict):
     """Search for bundles which match query"""
     for bundle in bundles.values():
@@ -479,8 +884,11 @@ def _updatesearch(query, itemsdict):
         return getsearchresult('Jungle Inferno', 'update', items)
 
 
-def _pricefilter(quality, criteria, amount, denom, results, pricesource):
-    """Search for items by price based on criteria"""
+def _pricefilter(quality, criteria, amount, denom, results, pricesource,
+                 priceindex=None, itemsdict=None, rank=False):
+    """Search for items by price based on criteria. If the results are of
+    all the items in itemsdict, they are taken from the price index instead
+    of being filtered, ordered by price if rank is true."""
     if not results:
         return
 
@@ -496,36 +904,23 @@ def _pricefilter(quality, criteria, amount, denom, results, pricesource):
         quality, criteria or '',
         _getpricestring(amount, denom) if not getall else 'Any')
 
-    for idx, result in enumerate(results):
-        items = []
-        for itemdict in result['items']:
-            price = itemdict['marketprice'][pricesource]
+    if priceindex:
+        keys = priceindex.getkeys(quality, None if getall else denom,
+                                  criteria, amount, rank)
+        if itemsdict is not None:
+            items = [itemsdict[key] for key in keys if key in itemsdict]
+            results[:] = [dict(results[0], items=items)] if items else []
+            return
+        matches = set(keys)
 
-            if quality not in price:
-                continue
-            elif getall:
-                items.append(itemdict)
-                continue
-
-            price = price[quality]
-
-            p = price.split()
-            valuelow = float(p[0])
-            valuehigh = float(p[2]) if len(p) == 4 else valuelow
-            pricedenom = p[-1].rstrip('s')
-
-            if denom != pricedenom:
-                continue
-
-            if criteria == '<':
-                match = valuelow < amount or valuehigh < amount
-            elif criteria == '>':
-                match = valuelow > amount or valuehigh > amount
-            else:
-                match = valuelow == amount or valuehigh == amount
-
-            if match:
-                items.append(itemdict)
+    for idx, result in enumerate(results):
+        if priceindex:
+            items = [itemdict for itemdict in result['items']
+                     if itemdict['index'] in matches]
+        else:
+            items = [itemdict for itemdict in result['items']
+                     if _ispricematch(itemdict['marketprice'][pricesource],
+                                      quality, criteria, amount, denom)]
 
         if items:
             results[idx]['items'] = items
@@ -535,6 +930,29 @@ def _pricefilter(quality, criteria, amount, denom, results, pricesource):
     results[:] = [result for result in results if result]
 
 
+def _ispricematch(price, quality, criteria, amount, denom):
+    """Check if the price of an item in quality matches criteria"""
+    if quality not in price:
+        return False
+    elif amount is None:
+        return True
+
+    p = price[quality].split()
+    valuelow = float(p[0])
+    valuehigh = float(p[2]) if len(p) == 4 else valuelow
+    pricedenom = p[-1].rstrip('s')
+
+    if denom != pricedenom:
+        return False
+
+    if criteria == '<':
+        return valuelow < amount or valuehigh < amount
+    elif criteria == '>':
+        return valuelow > amount or valuehigh > amount
+    else:
+        return valuelow == amount or valuehigh == amount
+
+
 def _getsetitems(itemset, nametoindexmap, itemsdict):
     """Get a list of the items in an item set"""
     setitems = []
@@ -580,7 +998,15 @@ def _getsorteditemlist(itemslist, querylist, query):
                   reverse=True)
 
 
-def _getpriceasitems(amount, denom, todenom, itemsdict, pricesource):
+def _getpricevizmatch(query):
+    """Match a price visualization query, eg. '1.5 keys to ref'"""
+    query = parseinput(query)['query']
+    return re.match(r'{}(?: (?:in|to) {})?$'.format(PRICEREGEX, DENOMREGEX),
+                    query.lower())
+
+
+def _getpriceasitems(amount, denom, todenom, itemsdict, pricesource,
+                     denomtable=None):
     """Return a list of itemdicts that visualize a given price and a dict
     with the count of each item."""
     items = []
@@ -589,7 +1015,8 @@ def _getpriceasitems(amount, denom, todenom, itemsdict, pricesource):
 
     denomtoidx = tf2api.getalldenoms()
     denoms = tuple(denomtoidx.keys())
-    denomtable = _getdenomvalues(itemsdict, pricesource)
+    if denomtable is None:
+        denomtable = _getdenomvalues(itemsdict, pricesource)
 
     if todenom:
         amount *= denomtable[denom][todenom]
@@ -676,6 +1103,29 @@ def _correctprice(amount, denom):
     return amount
 
 
+def _getbitset(positions):
+    """Return an int with the bits at the given positions set"""
+    positions = list(positions)
+    if not positions:
+        return 0
+    data = bytearray(max(positions) // 8 + 1)
+    for i in positions:
+        data[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(data, 'little')
+
+
+def _getpositions(bitset):
+    """Return the positions of the bits that are set in an int"""
+    data = bitset.to_bytes((bitset.bit_length() + 7) // 8, 'little')
+    return [i << 3 | j for i, byte in enumerate(data) if byte
+            for j in range(8) if byte >> j & 1]
+
+
+def _gettrigrams(string):
+    """Return the set of three character substrings of a string"""
+    return {string[i:i + 3] for i in range(len(string) - 2)}
+
+
 def _pluralize(wordlist):
     """Take a list of words and return a list of their plurals"""
     return [i + 's' for i in wordlist]
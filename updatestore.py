@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
-import sys
 import time
 import asyncio
+import argparse
+from collections import Counter, defaultdict
 from xml.dom.minidom import getDOMImplementation
 
 from slugify import slugify
@@ -9,8 +10,9 @@ from slugify import slugify
 import config
 import tf2api
 import tf2search
-from store import Redis
-from main import getitemkey, getclasskey, gettagkey
+from store import Redis, digest
+from main import (catalogformat, generation, parsecatalog, getcatalogkey,
+                  getitemkey)
 
 
 class Sitemap:
@@ -36,17 +38,35 @@ class Sitemap:
         return self.doc.toprettyxml()
 
 
-async def main(flush):
+async def main(flush, chunksize=1000, verbose=False, grace=60):
     store = Redis.from_url('redis://localhost')
 
-    tf2info = await tf2search.gettf2info(config.apikey,
-                                         config.backpackkey,
-                                         config.blueprintsfile)
+    cachedir = getattr(config, 'cachedir', None)
+    cache = (tf2api.ResponseCache(cachedir, getattr(config, 'cachemaxage', 0))
+             if cachedir else None)
+
+    await tf2api.opensession()
+    try:
+        tf2info = await tf2search.gettf2info(config.apikey,
+                                             config.backpackkey,
+                                             config.blueprintsfile,
+                                             cache)
+    finally:
+        await tf2api.closesession()
+
+    current, format_, lastupdated = parsecatalog(await store.get('catalog'))
+
+    # Items stored in an older format are rebuilt in the current one
+    flush = flush or format_ != catalogformat
 
     if flush:
-        await store.delete('items')
-        await store.delete_all('items:*')
-        await store.delete_all('item:*')
+        # Build a new generation of the catalog next to the one being served
+        # and switch to it once it is complete
+        generations = {int(g) for g in await store.smembers('catalogs')}
+        generation.set(max(generations | {current}) + 1)
+        await store.sadd('catalogs', generation.get())
+    else:
+        generation.set(current)
 
     suggestions = [[], [], []]
 
@@ -74,65 +94,196 @@ async def main(flush):
                     f'{config.homepage}/search/{quality}-{class_}-{tag}'
                 )
 
-    for index in tf2info.items:
-        async with store.pipeline() as pipe:
-            itemdict = tf2search.createitemdict(index, tf2info)
-            name = itemdict['name']
+    digests = await store.hgetall(getcatalogkey('items:digests'))
+    newdigests = {}
 
-            pipe.hset(getitemkey(index), mapping=itemdict)
-            pipe.sadd('items', index)
+    itemdicts = {}
+    denomitems = {}
+    marketprices = {}
+    slugs = {}
+    names = {}
+    members = defaultdict(set)
 
-            classes = itemdict['classes']
-            tags = itemdict['tags']
+    for index in tf2info.items:
+        itemdict = tf2search.createitemdict(index, tf2info)
+        name = itemdict['name']
 
-            if index == tf2info.itemsbyname[name]['defindex']:
-                slug = slugify(name)
+        newdigests[str(index)] = digest(itemdict)
+        if digests.get(str(index)) != newdigests[str(index)]:
+            itemdicts[index] = itemdict
 
-                pipe.hset('items:slugs', mapping={slug: index})
+        members[getcatalogkey('items')].add(index)
+        marketprices[index] = itemdict['marketprice']
+        if index in tf2api.getalldenoms().values():
+            denomitems[index] = itemdict
 
-                if tf2search.isvalidresult(itemdict, False):
-                    if not classes:
-                        pipe.sadd(getclasskey(), index)
-                    if len(classes) > 1:
-                        pipe.sadd(getclasskey(multi=True), index)
-                    if not tags:
-                        pipe.sadd(gettagkey(), index)
-                    for class_ in classes:
-                        pipe.sadd(getclasskey(class_), index)
-                    for tag in tags:
-                        pipe.sadd(gettagkey(tag), index)
+        if index == tf2info.itemsbyname[name]['defindex']:
+            slug = slugify(name)
 
-                if tf2search.isvalidresult(itemdict):
-                    pipe.sadd('items:indexes', index)
-                    pipe.hset('items:names', mapping={name: index})
+            slugs[slug] = index
 
-                    path = f'{config.homepage}/{slug}'
+            if tf2search.isvalidresult(itemdict):
+                members[getcatalogkey('items:indexes')].add(index)
+                names[name] = index
 
-                    suggestions[0].append(name)
-                    suggestions[1].append('{} - {}'.format(
-                        ', '.join(itemdict['classes']),
-                        ', '.join(itemdict['tags'])))
-                    suggestions[2].append(path)
+                path = f'{config.homepage}/{slug}'
 
-                    sitemap.add(path)
+                suggestions[0].append(name)
+                suggestions[1].append('{} - {}'.format(
+                    ', '.join(itemdict['classes']),
+                    ', '.join(itemdict['tags'])))
+                suggestions[2].append(path)
 
-            await pipe.execute()
+                sitemap.add(path)
 
-    await store.delete('items:new')
-    for index in tf2info.newstoreprices:
-        await store.sadd('items:new', index)
+    members[getcatalogkey('items:new')].update(tf2info.newstoreprices)
 
     bundles = {str(k): v for k, v in tf2info.bundles.items()}
 
+    prices = tf2search.getpricetable(marketprices)
+
+    denoms = {}
+    for source in prices:
+        try:
+            denoms[source] = tf2search.getdenomtable(denomitems, source)
+        except KeyError:
+            # The denomination items have no prices from this source
+            pass
+
     data = {'items:sets': tf2info.itemsets,
             'items:bundles': bundles,
             'items:suggestions': suggestions,
-            'items:lastupdated': time.time(),
+            'items:prices': prices,
+            'items:denoms': denoms,
             'sitemap': sitemap.toxml()}
 
-    await store.mset(data)
+    for key, value in data.items():
+        newdigests[key] = digest(value)
+
+    removed = [index for index in digests.keys() - newdigests.keys()
+               if index.isdigit()]
+
+    setkeys = [getcatalogkey(key)
+               for key in ('items', 'items:indexes', 'items:new')]
+    async with store.pipeline(transaction=False) as pipe:
+        for key in setkeys:
+            pipe.execute_command('SMEMBERS', key)
+        oldmembers = dict(zip(setkeys, await pipe.execute()))
+
+    oldslugs, oldnames = await asyncio.gather(
+        store.hgetall(getcatalogkey('items:slugs')),
+        store.hgetall(getcatalogkey('items:names')))
+
+    summary = Counter()
+
+    t0 = time.time()
+    commands = batches = 0
+
+    async with store.pipeline(transaction=False) as pipe:
+        for index, itemdict in itemdicts.items():
+            pipe.set(getitemkey(index), itemdict)
+
+            summary['changed items' if str(index) in digests else
+                    'added items'] += 1
+
+            sent = await pipe.execute_batch(chunksize)
+            commands += sent
+            batches += bool(sent)
+
+        for index in removed:
+            pipe.delete(getitemkey(index))
+            summary['removed items'] += 1
+
+        for key in setkeys:
+            new = {str(index) for index in members.get(key, ())}
+            old = {member.decode() for member in oldmembers[key]}
+            if new - old:
+                pipe.sadd(key, *(new - old))
+            if old - new:
+                pipe.srem(key, *(old - new))
+            summary['added set members'] += len(new - old)
+            summary['removed set members'] += len(old - new)
+
+        for key, new, old in (('items:slugs', slugs, oldslugs),
+                              ('items:names', names, oldnames)):
+            fields = {k: v for k, v in new.items() if old.get(k) != v}
+            oldfields = old.keys() - new.keys()
+            if fields:
+                pipe.hset(getcatalogkey(key), mapping=fields)
+            if oldfields:
+                pipe.hdel(getcatalogkey(key), *oldfields)
+            summary[f'changed {key} fields'] += len(fields) + len(oldfields)
+
+        for key, value in data.items():
+            if digests.get(key) != newdigests[key]:
+                pipe.set(getcatalogkey(key), value)
+                summary[f'changed {key}'] += 1
+
+        newdigests = {k: v for k, v in newdigests.items()
+                      if digests.get(k) != v}
+        if newdigests:
+            pipe.hset(getcatalogkey('items:digests'), mapping=newdigests)
+        if removed:
+            pipe.hdel(getcatalogkey('items:digests'), *removed)
+
+        # The site keys its caches on the last update time, so it only
+        # changes along with the catalog, or to add it to an older pointer
+        changed = flush or any(summary.values()) or lastupdated is None
+        if changed:
+            lastupdated = time.time()
+            pipe.set(getcatalogkey('items:lastupdated'), lastupdated)
+
+        sent = await pipe.execute_batch(1)
+        commands += sent
+        batches += bool(sent)
+
+    # The pointer holds the last update time as well, so that the site reads
+    # both at once
+    if changed:
+        await store.set('catalog', {'generation': generation.get(),
+                                    'format': catalogformat,
+                                    'lastupdated': lastupdated})
+
+    if verbose:
+        elapsed = time.time() - t0
+        print('Changed sources: {}'.format(
+            ', '.join(sorted(tf2info.changed)) or 'none'))
+        for change in sorted(summary):
+            print(f'{change.capitalize()}: {summary[change]:,}')
+        print(f'Stored {len(itemdicts):,} of {len(tf2info.items):,} items '
+              f'({len(itemdicts) / elapsed:,.0f} items/s, '
+              f'{commands:,} commands in {batches:,} batches)')
+        print(f'Updated generation {generation.get()} of the catalog '
+              f'in {elapsed:.2f}s')
+
+    if flush:
+        # Give requests still reading the previous generation time to finish
+        # before removing it, along with any abandoned by failed updates
+        await asyncio.sleep(grace)
+
+        generations = {int(g) for g in await store.smembers('catalogs')}
+        for catalog in (generations | {current}) - {generation.get()}:
+            if catalog:
+                await store.unlink_all(f'catalog:{catalog}:*')
+            else:
+                await store.unlink('items', 'sitemap')
+                await store.unlink_all('items:*')
+                await store.unlink_all('item:*')
+            await store.srem('catalogs', catalog)
 
 
 if __name__ == '__main__':
-    flush = len(sys.argv) == 2 and sys.argv[1] == '-f'
-    asyncio.run(main(flush))
+    parser = argparse.ArgumentParser(description='Update the item store')
+    parser.add_argument('-f', '--flush', action='store_true',
+                        help='rebuild the items as a new generation of the '
+                        'catalog')
+    parser.add_argument('-c', '--chunk-size', type=int, default=1000,
+                        help='number of commands sent to the store at once')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='report what changed in the store')
+    parser.add_argument('-g', '--grace', type=float, default=60,
+                        help='seconds to keep the previous generation of the '
+                        'catalog after a rebuild')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.flush, args.chunk_size, args.verbose, args.grace))
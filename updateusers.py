@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import time
+import asyncio
+import argparse
+
+import config
+import tf2api
+from store import Redis
+from main import (session_age, userrefreshage, userrefreshlease, getprofile,
+                  getuserkey, getrefreshkey, setvanityurl, setowneditems)
+
+
+async def main(age, limit=1000, concurrency=8, verbose=False):
+    store = Redis.from_url('redis://localhost')
+
+    t0 = time.time()
+
+    # Forget users whose sessions have expired since they were last active
+    await store.zremrangebyscore('users:active', 0,
+                                 t0 - session_age.total_seconds())
+
+    # Only users with a live session are refreshed, most recently active
+    # first, so Steam is called for the users of the site rather than for
+    # everyone who ever logged in
+    steamids = [steamid.decode() for steamid in
+                await store.zrevrange('users:active', 0, -1)]
+
+    async with store.pipeline(transaction=False) as pipe:
+        for steamid in steamids:
+            pipe.execute_command('HGET', getuserkey(steamid), 'lastupdate')
+        lastupdates = await pipe.execute()
+
+    stale = [steamid for steamid, lastupdate in zip(steamids, lastupdates)
+             if lastupdate is not None and t0 - float(lastupdate) > age]
+    stale = stale[:limit]
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def getbackpack(steamid):
+        async with semaphore:
+            try:
+                return await tf2api.getplayerbackpack(config.apikey, steamid)
+            except Exception as e:
+                # The stored items are kept until the next refresh
+                if verbose:
+                    print(f'Could not get the backpack of {steamid}: {e!r}')
+
+    updated = 0
+
+    await tf2api.opensession(limit=concurrency + 1)
+    try:
+        # GetPlayerSummaries accepts up to 100 steamids at once
+        for i in range(0, len(stale), 100):
+            batch = stale[i:i + 100]
+
+            # Users being refreshed by the site are left to it
+            async with store.pipeline(transaction=False) as pipe:
+                for steamid in batch:
+                    pipe.execute_command('SET', getrefreshkey(steamid), b'',
+                                         'NX', 'EX', userrefreshlease)
+                leases = await pipe.execute()
+            batch = [steamid for steamid, lease in zip(batch, leases)
+                     if lease]
+            if not batch:
+                continue
+
+            try:
+                steamusers = {
+                    steamuser['steamid']: steamuser for steamuser in
+                    await tf2api.getplayersummaries(config.apikey, batch)
+                }
+            except Exception as e:
+                if verbose:
+                    print(f'Could not get the summaries of {len(batch)} '
+                          f'users: {e!r}')
+                continue
+
+            batch = [steamid for steamid in batch if steamid in steamusers]
+            backpacks = await asyncio.gather(*map(getbackpack, batch))
+
+            async with store.pipeline(transaction=False) as pipe:
+                for steamid, backpack in zip(batch, backpacks):
+                    try:
+                        profile = getprofile(steamusers[steamid])
+                        setowneditems(pipe, steamid, backpack)
+                    except Exception as e:
+                        # One bad profile does not stop the others
+                        if verbose:
+                            print(f'Could not refresh {steamid}: {e!r}')
+                        continue
+                    pipe.hset(getuserkey(steamid), mapping=profile)
+                    setvanityurl(pipe, steamid, profile)
+                    updated += 1
+                await pipe.execute()
+
+    finally:
+        await tf2api.closesession()
+
+    if verbose:
+        print(f'Refreshed {updated} of {len(stale)} stale users out of '
+              f'{len(steamids)} active in {time.time() - t0:.1f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh the user profiles')
+    parser.add_argument('-a', '--age', type=float,
+                        default=max(0, userrefreshage - 60),
+                        help='seconds after which a profile is refreshed')
+    parser.add_argument('-n', '--limit', type=int, default=1000,
+                        help='maximum number of users refreshed, most '
+                        'recently active first')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='number of backpacks fetched at once')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='report the users that were refreshed')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.age, args.limit, args.concurrency, args.verbose))